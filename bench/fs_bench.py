@@ -0,0 +1,415 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#=======================================================================
+#  imgurfs - Virtual file system for Imgur
+#  fs_bench.py - File system benchmarks against a mock Imgur
+#  Copyright (c) 2012 Gaganpreet  <gaganpreet.arora@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+""" Runs ImgurFS calls the way the kernel would, against a mockimgur.py
+    server started for each scenario, so nothing is mounted and no
+    imgur account is needed:
+
+    startup     time to mounted and to the first `ls /`, on an empty
+                cache and again with the snapshot and saved session
+    ls          cold `ls -l` of / and every album, again while the
+                listings are fresh, and after a restart from the index
+    read_seq    whole images read in order, from imgur and from the cache
+    read_random small reads at random offsets of random images
+    upload      bulk create/write/release into an album, until the
+                uploads and album adds are done
+    concurrent  client threads mixing listings, stats and reads
+
+    Usage: fs_bench.py [options] [scenario ...]
+    Prints one JSON document with the settings and a result per
+    scenario. --compare checks the seconds of each scenario against an
+    earlier run and fails when one got slower than --threshold
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import random
+import shutil
+import optparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+try:
+    import fuse
+except ImportError:
+    print >> sys.stderr, 'fs_bench.py needs fuse-python 0.2 or later'
+    sys.exit(1)
+from imgurfs.fs import ImgurFS
+from imgurfs.metrics import setup_logging
+from mockimgur import MockImgur, account_options, make_account
+
+# fuse reads in blocks of up to this size
+BLOCK_SIZE = 128 * 1024
+
+def percentile (values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def latencies (values):
+    """ Summary of a list of latencies in seconds, in milliseconds """
+    return dict(p50_ms = percentile(values, 0.5) * 1000,
+                p90_ms = percentile(values, 0.9) * 1000,
+                p99_ms = percentile(values, 0.99) * 1000,
+                max_ms = values and max(values) * 1000 or 0)
+
+class Bench:
+    """ A mock server and an ImgurFS talking to it, in a scratch cache
+        directory. mount() can be called again for a restart on the
+        same cache
+    """
+
+    def __init__ (self, options, seed = 0):
+        self.options = options
+        self.server = MockImgur(make_account(options, seed))
+        self.server.start()
+        self.cache_dir = tempfile.mkdtemp(prefix = 'imgurfs-bench-')
+        self.fs = None
+
+    def mount (self, password = 'bench'):
+        """ Start an ImgurFS the way mount.imgurfs does, returns the
+            seconds it took to be mounted """
+        fs = ImgurFS()
+        fs.cache_dir = self.cache_dir
+        fs.api_endpoint = self.server.endpoint
+        for option in ('concurrency', 'connections', 'prefetch',
+                       'upload_workers'):
+            setattr(fs, option, getattr(self.options, option))
+        fs.setup('bench', password)
+        fs.imgur.page_size = self.options.page_size
+        fs.fsinit()
+        self.fs = fs
+        return fs.startup['mounted']
+
+    def warmed_up (self, timeout = 60):
+        """ Wait for the startup sign in and listing of / """
+        deadline = time.time() + timeout
+        while 'listed' not in self.fs.startup and time.time() < deadline:
+            time.sleep(0.01)
+
+    def requests (self):
+        return self.server.account.stats['api_requests']
+
+    def close (self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir, ignore_errors = True)
+
+    def ls (self, path):
+        """ readdir and getattr of everything in path, like ls -l """
+        names = [d.name for d in self.fs.readdir(path, 0)
+                 if d.name not in ('.', '..')]
+        for name in names:
+            st = self.fs.getattr(path.rstrip('/') + '/' + name)
+            if isinstance(st, int):
+                raise OSError(-st, os.strerror(-st), name)
+        return names
+
+    def ls_all (self):
+        """ ls -l of / and every album, returns the entries seen """
+        names = self.ls('/')
+        albums = self.fs.imgur.album_list()
+        for name in names:
+            if name in albums:
+                names = names + self.ls('/' + name)
+        return len(names)
+
+    def images (self):
+        """ Paths of the images in / """
+        return sorted('/' + name for name in self.fs.imgur.image_list(None))
+
+    def read (self, path, offset = 0, length = None):
+        """ open, read and release like cat or a partial read would
+            Returns the number of bytes read
+        """
+        # Like fuse, hand the handle open returns to read and release
+        fh = self.fs.open(path, os.O_RDONLY)
+        if isinstance(fh, int):
+            if fh:
+                raise OSError(-fh, os.strerror(-fh), path)
+            fh = None
+        total = 0
+        try:
+            while length == None or total < length:
+                size = BLOCK_SIZE
+                if length != None:
+                    size = min(size, length - total)
+                data = self.fs.read(path, size, offset + total, fh)
+                if isinstance(data, int):
+                    raise OSError(-data, os.strerror(-data), path)
+                total += len(data)
+                if len(data) < size:
+                    break
+        finally:
+            self.fs.release(path, os.O_RDONLY, fh)
+        return total
+
+def scenario_startup (options):
+    bench = Bench(options)
+    try:
+        result = {}
+        # The restart has no password, it has to use the saved session
+        for run, password in (('cold', 'bench'), ('restart', None)):
+            signins = bench.server.account.stats['signins']
+            result[run + '_mounted_seconds'] = bench.mount(password)
+            result[run + '_entries'] = len(bench.ls('/'))
+            result[run + '_first_ls_seconds'] = bench.fs.startup['first_ls']
+            bench.warmed_up()
+            result[run + '_listed_seconds'] = bench.fs.startup.get('listed')
+            result[run + '_signins'] = bench.server.account.stats['signins'] - signins
+        result['seconds'] = result['cold_first_ls_seconds'] + \
+                            result['restart_first_ls_seconds']
+        return result
+    finally:
+        bench.close()
+
+def scenario_ls (options):
+    bench = Bench(options)
+    try:
+        mounted = bench.mount()
+        start = time.time()
+        entries = bench.ls_all()
+        cold = time.time() - start
+        cold_requests = bench.requests()
+
+        start = time.time()
+        bench.ls_all()
+        warm = time.time() - start
+
+        # A new mount on the same cache starts from the index snapshot
+        restart_mounted = bench.mount()
+        requests = bench.requests()
+        start = time.time()
+        bench.ls_all()
+        restart = time.time() - start
+        return dict(seconds = cold, entries = entries, mount_seconds = mounted,
+                    api_requests = cold_requests, warm_seconds = warm,
+                    restart_seconds = restart,
+                    restart_mount_seconds = restart_mounted,
+                    restart_api_requests = bench.requests() - requests)
+    finally:
+        bench.close()
+
+def scenario_read_seq (options):
+    bench = Bench(options)
+    try:
+        bench.mount()
+        paths = bench.images()[:options.files]
+        result = dict(files = len(paths))
+        for run in ('cold', 'warm'):
+            start = time.time()
+            total = sum(bench.read(path) for path in paths)
+            seconds = time.time() - start
+            result[run + '_seconds'] = seconds
+            result[run + '_mb_per_s'] = total / 1048576.0 / max(seconds, 1e-6)
+            result['bytes'] = total
+        result['seconds'] = result['cold_seconds']
+        result['pool'] = dict(bench.fs.buf.http.stats)
+        return result
+    finally:
+        bench.close()
+
+def scenario_read_random (options):
+    bench = Bench(options)
+    try:
+        bench.mount()
+        paths = bench.images()[:options.files]
+        size = options.image_size * 1024
+        rand = random.Random(1)
+        times = []
+        start = time.time()
+        for i in xrange(options.reads):
+            path = rand.choice(paths)
+            offset = rand.randrange(0, max(size - 4096, 1))
+            begin = time.time()
+            bench.read(path, offset, 4096)
+            times.append(time.time() - begin)
+        seconds = time.time() - start
+        result = dict(seconds = seconds, reads = options.reads,
+                      reads_per_s = options.reads / max(seconds, 1e-6),
+                      bytes_sent = bench.server.account.stats['bytes_sent'])
+        result.update(latencies(times))
+        return result
+    finally:
+        bench.close()
+
+def scenario_upload (options):
+    bench = Bench(options)
+    try:
+        bench.mount()
+        fs = bench.fs
+        fs.mkdir('/bench', 0755)
+        data = os.urandom(options.image_size * 1024)
+        requests = bench.requests()
+        start = time.time()
+        for i in xrange(options.uploads):
+            path = '/bench/upload%05d.png' % i
+            fs.create(path, os.O_WRONLY, 0100644)
+            for offset in xrange(0, len(data), BLOCK_SIZE):
+                fs.write(path, data[offset:offset + BLOCK_SIZE], offset)
+            fs.release(path, os.O_WRONLY)
+        released = time.time() - start
+        fs.uploads.queue.join()
+        uploaded = time.time() - start
+        fs.imgur.batcher.flush()
+        seconds = time.time() - start
+        failed = [u for u in fs.uploads.status() if u['state'] != 'done']
+        return dict(seconds = seconds, uploads = options.uploads,
+                    release_seconds = released, upload_seconds = uploaded,
+                    uploads_per_s = options.uploads / max(seconds, 1e-6),
+                    failed = len(failed),
+                    api_requests = bench.requests() - requests)
+    finally:
+        bench.close()
+
+def scenario_concurrent (options):
+    bench = Bench(options)
+    try:
+        bench.mount()
+        paths = bench.images()[:options.files]
+        albums = ['/'] + ['/' + name for name in bench.fs.imgur.album_list()]
+        times = []
+        errors = []
+        lock = threading.Lock()
+
+        def client (seed):
+            rand = random.Random(seed)
+            mine = []
+            for i in xrange(options.ops):
+                begin = time.time()
+                try:
+                    choice = rand.random()
+                    if choice < 0.2:
+                        bench.ls(rand.choice(albums))
+                    elif choice < 0.5:
+                        bench.fs.getattr(rand.choice(paths))
+                    else:
+                        bench.read(rand.choice(paths))
+                except Exception, e:
+                    with lock:
+                        errors.append(str(e))
+                mine.append(time.time() - begin)
+            with lock:
+                times.extend(mine)
+
+        threads = [threading.Thread(target = client, args = (i,))
+                   for i in xrange(options.clients)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.time() - start
+        result = dict(seconds = seconds, clients = options.clients,
+                      ops = len(times), ops_per_s = len(times) / max(seconds, 1e-6),
+                      errors = len(errors), api_requests = bench.requests())
+        result.update(latencies(times))
+        return result
+    finally:
+        bench.close()
+
+SCENARIOS = [('startup', scenario_startup), ('ls', scenario_ls), ('read_seq', scenario_read_seq),
+             ('read_random', scenario_read_random), ('upload', scenario_upload),
+             ('concurrent', scenario_concurrent)]
+
+def compare (results, baseline, threshold):
+    """ Print how the seconds of each scenario changed against baseline,
+        returns the scenarios that got slower than threshold """
+    slower = []
+    for name, result in results['scenarios'].iteritems():
+        before = baseline.get('scenarios', {}).get(name)
+        if not before or not before.get('seconds'):
+            continue
+        change = result['seconds'] / before['seconds'] - 1
+        print >> sys.stderr, '%-12s %8.3fs -> %8.3fs  %+6.1f%%' % \
+              (name, before['seconds'], result['seconds'], change * 100)
+        if change > threshold:
+            slower.append(name)
+    return slower
+
+def main ():
+    parser = optparse.OptionParser(usage = '%prog [options] [scenario ...]')
+    account_options(parser)
+    parser.add_option('--concurrency', type = 'int', default = 4,
+                      help = 'listing pages fetched in parallel [default: %default]')
+    parser.add_option('--connections', type = 'int', default = 4,
+                      help = 'keep-alive connections per host [default: %default]')
+    parser.add_option('--prefetch', type = 'int', default = 0,
+                      help = 'images prefetched after reads [default: %default]')
+    parser.add_option('--upload-workers', type = 'int', default = 2,
+                      help = 'images uploaded in parallel [default: %default]')
+    parser.add_option('--files', type = 'int', default = 50,
+                      help = 'images read by the read scenarios [default: %default]')
+    parser.add_option('--reads', type = 'int', default = 500,
+                      help = 'reads done by read_random [default: %default]')
+    parser.add_option('--uploads', type = 'int', default = 50,
+                      help = 'images written by upload [default: %default]')
+    parser.add_option('--clients', type = 'int', default = 8,
+                      help = 'threads in concurrent [default: %default]')
+    parser.add_option('--ops', type = 'int', default = 50,
+                      help = 'operations per client in concurrent [default: %default]')
+    parser.add_option('-o', '--output', metavar = 'FILE',
+                      help = 'write the results to FILE too')
+    parser.add_option('--compare', metavar = 'FILE',
+                      help = 'results of an earlier run to compare with')
+    parser.add_option('--threshold', type = 'float', default = 0.2,
+                      help = 'slowdown that fails --compare [default: %default]')
+    parser.add_option('-v', '--verbose', action = 'store_true',
+                      help = 'log what imgurfs does to stderr')
+    options, args = parser.parse_args()
+    names = [name for name, function in SCENARIOS]
+    for name in args:
+        if name not in names:
+            parser.error('unknown scenario %s, pick from %s' % (name, ', '.join(names)))
+
+    settings = dict(vars(options))
+    for option in ('output', 'compare', 'threshold', 'verbose'):
+        del settings[option]
+    results = dict(time = time.strftime('%Y-%m-%d %H:%M:%S'),
+                   settings = settings, scenarios = {})
+
+    if options.verbose:
+        setup_logging('debug')
+    for name, function in SCENARIOS:
+        if not args or name in args:
+            results['scenarios'][name] = function(options)
+
+    output = json.dumps(results, indent = 2, sort_keys = True)
+    print output
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    if options.compare:
+        with open(options.compare) as f:
+            slower = compare(results, json.load(f), options.threshold)
+        if slower:
+            print >> sys.stderr, 'Slower:', ', '.join(slower)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
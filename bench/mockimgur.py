@@ -0,0 +1,365 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#=======================================================================
+#  imgurfs - Virtual file system for Imgur
+#  mockimgur.py - Local server emulating the Imgur v2 api
+#  Copyright (c) 2012 Gaganpreet  <gaganpreet.arora@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+""" Serves the parts of the Imgur v2 api that api.py uses, from memory:
+    signin (with the session cookie account calls need), images_count,
+    albums_count, the paged images and albums listings, album contents,
+    album creation and adds, uploads, and the image files themselves
+    (with Range support)
+
+    Latency, the largest page served, and the rate limit are
+    configurable, so runs are repeatable without an imgur account.
+
+    Usage: mockimgur.py [--port N] [--images N] [--albums N] ...
+    then mount with -o api_endpoint=http://127.0.0.1:N/2/
+"""
+
+import re
+import cgi
+import json
+import time
+import uuid
+import base64
+import Cookie
+import random
+import hashlib
+import optparse
+import threading
+import urlparse
+import SocketServer
+import BaseHTTPServer
+
+class Image:
+    """ One image in the mock account
+        Generated images only keep their size, their bytes are made up
+        from the hash when they are downloaded
+    """
+
+    def __init__ (self, imagehash, name, datetime, size = 0, data = None):
+        self.hash = imagehash
+        self.name = name
+        self.datetime = datetime
+        self.size = data == None and size or len(data)
+        self.stored = data
+
+    @property
+    def data (self):
+        if self.stored != None:
+            return self.stored
+        block = hashlib.sha512(self.hash).digest() * 64
+        return (block * (self.size / len(block) + 1))[:self.size]
+
+    def as_dict (self, base):
+        link = '%simg/%s.png' % (base, self.hash)
+        return dict(image = dict(hash = self.hash, name = self.name,
+                                 title = '', caption = '',
+                                 deletehash = 'd' + self.hash,
+                                 datetime = self.datetime,
+                                 type = 'image/png', animated = 'false',
+                                 width = 1, height = 1, size = self.size,
+                                 views = 0, bandwidth = 0),
+                    links = dict(original = link))
+
+class Account:
+    """ Images and albums of the mock account, and its rate limit """
+
+    def __init__ (self, images = 1000, albums = 10, album_size = 20,
+                  image_size = 64 * 1024, page_size = 100, latency = 0,
+                  rate_limit = 12500, window = 3600, seed = 0):
+        self.page_size = page_size
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.window = window
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        # Newest first, like the api lists them
+        self.images = []
+        self.hashes = {}
+        # album id -> [title, datetime, [image hashes]]
+        self.albums = {}
+        self.album_order = []
+        # Session cookies handed out by signin
+        self.sessions = set()
+        self.reset()
+
+        for i in xrange(images):
+            self.add_image('image%05d.png' % i, size = image_size)
+        hashes = [image.hash for image in self.images]
+        for i in xrange(albums):
+            album = self.add_album('album%03d' % i)
+            self.albums[album][2].extend(hashes[i * album_size:(i + 1) * album_size])
+
+        self.stats = dict(requests = 0, api_requests = 0, uploads = 0,
+                          limited = 0, bytes_sent = 0, signins = 0)
+
+    def reset (self):
+        """ Start a new rate limit window """
+        self.remaining = self.rate_limit
+        self.reset_time = int(time.time()) + self.window
+
+    def make_hash (self):
+        while True:
+            imagehash = ''.join(self.random.choice('abcdefghijklmnopqrstuvwxyz'
+                                                   'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+                                                   '0123456789') for i in xrange(7))
+            if imagehash not in self.hashes and imagehash not in self.albums:
+                return imagehash
+
+    def add_image (self, name, data = None, size = 0):
+        with self.lock:
+            image = Image(self.make_hash(), name,
+                          time.strftime('%Y-%m-%d %H:%M:%S'), size, data)
+            self.images.insert(0, image)
+            self.hashes[image.hash] = image
+            return image
+
+    def add_album (self, title):
+        with self.lock:
+            album = self.make_hash()
+            self.albums[album] = [title, time.strftime('%Y-%m-%d %H:%M:%S'), []]
+            self.album_order.insert(0, album)
+            return album
+
+    def unorganized (self):
+        with self.lock:
+            organized = set()
+            for title, datetime, hashes in self.albums.itervalues():
+                organized.update(hashes)
+            return [image for image in self.images if image.hash not in organized]
+
+    def charge (self):
+        """ Count an api request against the rate limit, False if over """
+        with self.lock:
+            self.stats['api_requests'] += 1
+            if time.time() >= self.reset_time:
+                self.reset()
+            if self.remaining <= 0:
+                self.stats['limited'] += 1
+                return False
+            self.remaining -= 1
+            return True
+
+def page (items, query, page_size):
+    """ The page of items a listing request asks for """
+    number = max(int(query.get('page', ['1'])[0]), 1)
+    count = min(int(query.get('count', [str(page_size)])[0]), page_size)
+    return items[(number - 1) * count:number * count]
+
+class Handler (BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answers api and image requests for server.account """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message (self, format, *args):
+        pass
+
+    def send (self, code, body, headers = {}):
+        account = self.server.account
+        self.send_response(code)
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        with account.lock:
+            account.stats['bytes_sent'] += len(body)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json (self, code, result, headers = {}):
+        account = self.server.account
+        self.send(code, json.dumps(result),
+                  dict(headers, **{'Content-Type': 'application/json',
+                                   'X-RateLimit-Limit': str(account.rate_limit),
+                                   'X-RateLimit-Remaining': str(max(account.remaining, 0)),
+                                   'X-RateLimit-Reset': str(account.reset_time)}))
+
+    def session (self):
+        """ The session cookie sent with the request, None if none """
+        cookies = Cookie.SimpleCookie(self.headers.getheader('cookie') or '')
+        return 'IMGURSESSION' in cookies and cookies['IMGURSESSION'].value or None
+
+    def error (self, code, message):
+        self.send_json(code, dict(error = dict(message = message)))
+
+    def form (self):
+        """ Fields of a urlencoded or multipart POST body """
+        form = cgi.FieldStorage(fp = self.rfile, headers = self.headers,
+                                environ = {'REQUEST_METHOD': 'POST',
+                                           'CONTENT_TYPE': self.headers.getheader('content-type')})
+        return dict((key, form.getfirst(key)) for key in form.keys())
+
+    def do_GET (self):
+        self.handle_request('GET')
+
+    def do_POST (self):
+        self.handle_request('POST')
+
+    def handle_request (self, method):
+        account = self.server.account
+        with account.lock:
+            account.stats['requests'] += 1
+        parts = urlparse.urlsplit(self.path)
+        query = urlparse.parse_qs(parts.query)
+        path = parts.path
+
+        match = re.match(r'^/img/(\w+)\.\w+$', path)
+        if match:
+            return self.send_image(match.group(1))
+        if not path.startswith('/2/'):
+            return self.error(404, 'Not found')
+
+        fields = method == 'POST' and self.form() or {}
+        if account.latency:
+            time.sleep(account.latency)
+        if not account.charge():
+            return self.error(403, 'API limits exceeded')
+        path = path[len('/2/'):]
+
+        if path == 'signin.json' and method == 'POST':
+            session = uuid.uuid4().hex
+            with account.lock:
+                account.sessions.add(session)
+                account.stats['signins'] += 1
+            return self.send_json(200, dict(signin = dict(message = 'Logged in')),
+                                  {'Set-Cookie': 'IMGURSESSION=%s; Path=/' % session})
+        if path.startswith('account/') and self.session() not in account.sessions:
+            return self.error(401, 'Not logged in')
+        if path == 'account/images_count.json':
+            return self.send_json(200, dict(images_count = dict(count = len(account.unorganized()))))
+        if path == 'account/albums_count.json':
+            return self.send_json(200, dict(albums_count = dict(count = len(account.albums))))
+        if path == 'account/images.json' and method == 'GET':
+            images = query.get('noalbum') and account.unorganized() or account.images
+            return self.send_json(200, dict(images = [image.as_dict(self.server.base)
+                                                      for image in page(images, query,
+                                                                        account.page_size)]))
+        if path == 'account/images.json' and method == 'POST':
+            return self.upload(fields)
+        if path == 'account/albums.json' and method == 'GET':
+            albums = [dict(id = album, title = account.albums[album][0],
+                           datetime = account.albums[album][1],
+                           description = '', privacy = 'public', layout = 'blog')
+                      for album in page(account.album_order, query, account.page_size)]
+            return self.send_json(200, dict(albums = albums))
+        if path == 'account/albums.json' and method == 'POST':
+            album = account.add_album(fields.get('title') or '')
+            return self.send_json(200, dict(albums = dict(id = album)))
+
+        match = re.match(r'^account/albums/(\w+)\.json$', path)
+        if match and match.group(1) in account.albums:
+            album = account.albums[match.group(1)]
+            if method == 'GET':
+                return self.send_json(200, dict(albums = [account.hashes[h].as_dict(self.server.base)
+                                                          for h in album[2]]))
+            with account.lock:
+                for imagehash in (fields.get('add_images') or '').split(','):
+                    if imagehash in account.hashes and imagehash not in album[2]:
+                        album[2].insert(0, imagehash)
+            return self.send_json(200, dict(albums = dict(id = match.group(1))))
+        return self.error(404, 'Not found')
+
+    def upload (self, fields):
+        account = self.server.account
+        if not fields.get('image'):
+            return self.error(400, 'No image data')
+        data = fields['image']
+        if fields.get('type') == 'base64':
+            data = base64.b64decode(data)
+        image = account.add_image(fields.get('name') or '', data = data)
+        with account.lock:
+            account.stats['uploads'] += 1
+        return self.send_json(200, dict(images = image.as_dict(self.server.base)))
+
+    def send_image (self, imagehash):
+        image = self.server.account.hashes.get(imagehash)
+        if image == None:
+            return self.error(404, 'Not found')
+        data = image.data
+        match = re.match(r'^bytes=(\d+)-(\d*)$', self.headers.getheader('range') or '')
+        if match and data:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+            if start >= len(data):
+                return self.send(416, '', {'Content-Range': 'bytes */%d' % len(data)})
+            return self.send(206, data[start:end + 1],
+                             {'Content-Type': 'image/png',
+                              'Content-Range': 'bytes %d-%d/%d' % (start, end, len(data))})
+        self.send(200, data, {'Content-Type': 'image/png'})
+
+class MockImgur (SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ The mock api server, serve_forever() runs it
+        Point Imgur at endpoint, e.g. Imgur(user, password, index, http,
+        server.endpoint)
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__ (self, account, port = 0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.account = account
+        self.base = 'http://127.0.0.1:%d/' % self.server_address[1]
+        self.endpoint = self.base + '2/'
+
+    def start (self):
+        """ Serve from a background thread """
+        thread = threading.Thread(target = self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+def account_options (parser):
+    """ Add the options that describe the mock account to parser """
+    parser.add_option('--images', type = 'int', default = 1000,
+                      help = 'images in the account [default: %default]')
+    parser.add_option('--albums', type = 'int', default = 10,
+                      help = 'albums in the account [default: %default]')
+    parser.add_option('--album-size', type = 'int', default = 20,
+                      help = 'images per album [default: %default]')
+    parser.add_option('--image-size', type = 'int', default = 64,
+                      help = 'size of each image in KB [default: %default]')
+    parser.add_option('--page-size', type = 'int', default = 100,
+                      help = 'most items served per listing page [default: %default]')
+    parser.add_option('--latency', type = 'float', default = 0,
+                      help = 'seconds added to each api request [default: %default]')
+    parser.add_option('--rate-limit', type = 'int', default = 12500,
+                      help = 'api requests allowed per window [default: %default]')
+    parser.add_option('--window', type = 'int', default = 3600,
+                      help = 'length of the rate limit window in seconds [default: %default]')
+
+def make_account (options, seed = 0):
+    return Account(options.images, options.albums, options.album_size,
+                   options.image_size * 1024, options.page_size,
+                   options.latency, options.rate_limit, options.window, seed)
+
+def main ():
+    parser = optparse.OptionParser(usage = '%prog [options]')
+    parser.add_option('--port', type = 'int', default = 8080,
+                      help = 'port to listen on [default: %default]')
+    account_options(parser)
+    options, args = parser.parse_args()
+    server = MockImgur(make_account(options), options.port)
+    print 'Serving', server.endpoint
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#=======================================================================
+#  imgurfs - Virtual file system for Imgur
+#  upload_memory.py - Peak memory of building an upload request body
+#  Copyright (c) 2012 Gaganpreet  <gaganpreet.arora@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+""" Compares the peak memory of the old urlencoded upload body with the
+    streamed Base64Multipart one. Each run happens in its own process,
+    the growth of its peak RSS is what one upload allocates.
+
+    Usage: upload_memory.py [size in MB]
+    Prints one JSON object per mode
+"""
+
+import os
+import sys
+import json
+import urllib
+import base64
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src', 'imgurfs'))
+from buf import WriteBuffer, WriteBufferReader
+from conn import Base64Multipart
+
+def make_buffer (size):
+    """ A write buffer on disk holding size random bytes """
+    buffer = WriteBuffer()
+    buffer.spill()
+    for offset in xrange(0, size, 64 * 1024):
+        buffer.write(os.urandom(min(64 * 1024, size - offset)), offset)
+    return buffer
+
+def peak_rss ():
+    """ Peak resident size of this process in bytes """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def run (mode, size):
+    data = WriteBufferReader(make_buffer(size))
+    before = peak_rss()
+    sent = 0
+    if mode == 'urlencode':
+        body = urllib.urlencode(dict(name = 'bench.png', type = 'base64',
+                                     image = base64.b64encode(data.read())))
+        sent = len(body)
+    else:
+        body = Base64Multipart(dict(name = 'bench.png', type = 'base64'),
+                               'image', data)
+        # httplib reads streamed bodies in 8 KB blocks
+        while True:
+            block = body.read(8192)
+            if not block:
+                break
+            sent += len(block)
+    return dict(mode = mode, image_bytes = size, body_bytes = sent,
+                allocated_bytes = peak_rss() - before)
+
+def main ():
+    if len(sys.argv) > 2:
+        print json.dumps(run(sys.argv[2], int(sys.argv[1])))
+        return
+    size = int(float(len(sys.argv) > 1 and sys.argv[1] or 10) * 1024 * 1024)
+    for mode in ('urlencode', 'multipart'):
+        subprocess.check_call([sys.executable, __file__, str(size), mode])
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,6 @@ setup (name = 'imgurfs',
        license = 'GPL-3',
        packages = ['imgurfs'],
        package_dir = {'imgurfs' : 'src/imgurfs/'},
-       scripts = ['src/mount.imgurfs'],
+       scripts = ['src/mount.imgurfs', 'src/imgurfs-import'],
        data_files = df
       )
@@ -20,7 +20,7 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #=======================================================================
 
-import sys
+import errno
 import urllib
 import urllib2
 try:
@@ -28,168 +28,470 @@ try:
 except ImportError:
     import json as simplejson
 import time
-from base64 import b64encode
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+from index import ImageRecord, AlbumRecord
+from sync import SingleFlight
+from conn import Base64Multipart
+from scheduler import RequestScheduler, INTERACTIVE, UPLOAD
+from refresh import Refresher
+from metrics import metrics
+from offline import Offline
+
+log = logging.getLogger('imgurfs.api')
 
 class Imgur:
     """ Wrapper for the Imgur api """
+    # Items asked for per listing page
+    page_size = 100
 
-    def __init__ (self, username, password):
-        """ Signs into imgur """
+    def __init__ (self, username, password, index, http,
+                  api_endpoint = 'https://api.imgur.com/2/'):
+        """ Nothing is sent until the first api request, which signs
+            in unless http has a session cookie from an earlier run
+            http is the ConnectionPool shared with image downloads
+        """
         # TODO: Error checking for api requests
-        self.api_endpoint = 'https://api.imgur.com/2/'
-        self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor())
-        urllib2.install_opener(self.opener)
+        self.api_endpoint = api_endpoint
+        self.http = http
+        self.username = username
+        # None if we can only use the saved session
+        self.password = password
+        self.session = len(http.cookies) > 0
+        self.signin_lock = threading.Lock()
+        # Why the last sign in failed, for the stats
+        self.signin_error = None
  
-        # We use cache to cache image and album list for 10 seconds
-        # TODO: Make cache duration a command line option
-
-        # Cache for images, album name is the key in the dictionary
-        # None album points to unorganized images (/ directory)
-        self.cache = {}
+        # Image and album listings live in a MetadataIndex. Expired ones
+        # are still served while the refresher fetches them again
+        self.index = index
+        self.refresher = Refresher(self, 100, 1800)
+        # Refreshes only fetch new pages, a full listing is done when
+        # the counts don't add up or every reconcile_interval seconds
+        self.reconcile_interval = 3600
+        self.reconciled = {}
+        self.unreconciled = set()
+        # Listing key (album name, None or '/') -> pages fetched and saved
+        # by the last refresh
+        self.refresh_stats = {}
         self.count = 0
-        # Cache for albums
-        self.cache_albums = {'time': 0, 
-                             'list': {}}
         self.album_count = 0
 
+        # Listing pages are fetched by up to concurrency threads. The pool
+        # is started on first use, fuse forks into the background after
+        # we are constructed and threads don't survive that
+        self.concurrency = 4
+        self.pool = None
+        self.ratelimit_lock = threading.Lock()
+        self.in_flight = 0
+        # Listing refreshes in progress, keyed by album
+        # (None for unorganized images, '/' for the album list)
+        self.flights = SingleFlight()
+        # Optional AlbumBatcher that coalesces album adds after uploads
+        self.batcher = None
+        # Paces requests by the rate limit, see scheduler.py
+        self.scheduler = RequestScheduler()
+        # Unknown until the first response
+        self.ratelimit = dict(remaining = None, limit = None)
+
+    def sign_in (self):
+        """ Sign in for a session cookie, unless we have one
+            The cookie is saved with the other cookies of http, so the
+            next run doesn't have to sign in. Raises IOError EACCES
+            if imgur refuses the credentials
+        """
+        with self.signin_lock:
+            if self.session:
+                return
+            if self.password == None:
+                self.signin_error = 'session expired and no password to sign in with'
+                raise IOError(errno.EACCES, self.signin_error)
+            try:
+                with metrics.timer('api.signin.json'):
+                    r = self.http.request(self.api_endpoint + 'signin.json',
+                                          urllib.urlencode({'username' : self.username,
+                                                            'password' : self.password}))
+            except urllib2.HTTPError, e:
+                if e.code >= 500:
+                    raise
+                try:
+                    self.signin_error = simplejson.loads(e.readline())['error']['message']
+                except (ValueError, KeyError, TypeError):
+                    self.signin_error = str(e)
+                log.error('Signing in failed: %s', self.signin_error)
+                raise IOError(errno.EACCES, self.signin_error)
+            self.update_ratelimit(r.headers.dict)
+            self.http.save_cookies()
+            self.session = True
+            self.signin_error = None
+            log.info('Signed in as %s', self.username)
+
+    def api_request (self, url, parameters = None, priority = INTERACTIVE):
+        """ Make an api request and return the result
+            parameters are urlencoded, unless it's a body object like
+            Base64Multipart which is streamed as is
+
+            The request waits for the scheduler, which raises RateLimited
+            if the rate limit left is reserved for higher priorities
+        """
+        log.debug('api request %s', url)
+        endpoint = url.split('?')[0]
+        if endpoint.startswith('account/albums/'):
+            # Not a histogram per album
+            endpoint = 'account/albums/ID.json'
+        with metrics.timer('api.wait'):
+            self.scheduler.acquire(priority)
+
+        if not self.session:
+            self.sign_in()
+
+        with self.ratelimit_lock:
+            self.in_flight += 1
+        start = time.time()
         try:
-            r = self.opener.open(self.api_endpoint + 'signin.json',
-                        urllib.urlencode({'username' : username,
-                                          'password' : password}))
-            # TODO: Use ratelimit in statfs
-            self.ratelimit = dict(remaining = r.headers.dict['x-ratelimit-remaining'],
-                                  limit = r.headers.dict['x-ratelimit-limit'])
-        except urllib2.HTTPError, e:
-            error = simplejson.loads(e.readline())
-            if error.has_key('error'):
-                print error['error']['message']
-                sys.exit(0)
-
-    def api_request (self, url, parameters = None):
-        """ Make an api request and return the result """
-        print 'Got api request for url ' + url
+            try:
+                r = self.send_request(url, parameters)
+            except urllib2.HTTPError, e:
+                if e.code != 401:
+                    raise
+                # The saved session expired. A streamed body can't be
+                # sent again, the caller retries it after we signed in
+                self.session = False
+                if hasattr(parameters, 'read'):
+                    raise
+                self.sign_in()
+                r = self.send_request(url, parameters)
+            self.update_ratelimit(r.headers.dict)
+        except Exception:
+            metrics.incr('api.errors')
+            raise
+        finally:
+            metrics.observe('api.' + endpoint, time.time() - start)
+            with self.ratelimit_lock:
+                self.in_flight -= 1
+        return r.readline()
 
+    def send_request (self, url, parameters):
+        """ Send an api request as GET, or POST if there are parameters """
         # Make a GET request
         if parameters == None:
-            r = self.opener.open(self.api_endpoint + url)
+            return self.http.request(self.api_endpoint + url)
+        # Make a POST request with a streamed body
+        elif hasattr(parameters, 'read'):
+            return self.http.request(self.api_endpoint + url, parameters,
+                                     {'Content-type': parameters.content_type,
+                                      'Content-length': str(len(parameters))})
         # Make a POST request
         else:
-            r = self.opener.open(self.api_endpoint + url, 
-                                 urllib.urlencode(parameters))
+            return self.http.request(self.api_endpoint + url, 
+                                     urllib.urlencode(parameters))
 
-        self.ratelimit = dict(remaining = r.headers.dict['x-ratelimit-remaining'],
-                              limit = r.headers.dict['x-ratelimit-limit'])
-        return r.readline()
+    def update_ratelimit (self, headers):
+        """ Record the rate limit reported by a response
+            Responses to concurrent requests can arrive out of order, so
+            while others are in flight only a lower count is taken
+        """
+        remaining = int(headers['x-ratelimit-remaining'])
+        limit = int(headers['x-ratelimit-limit'])
+        reset = headers.get('x-ratelimit-reset')
+        with self.ratelimit_lock:
+            if self.in_flight > 1 and self.ratelimit['remaining'] != None:
+                remaining = min(remaining, self.ratelimit['remaining'])
+            self.ratelimit = dict(remaining = remaining, limit = limit)
+        self.scheduler.update(remaining, limit, reset and int(reset))
+
+    def map_pages (self, function, pages):
+        """ Call function on every page number in parallel, results are
+            returned in page order """
+        if len(pages) < 2 or self.concurrency < 2:
+            return map(function, pages)
+        if self.pool == None:
+            self.pool = ThreadPool(self.concurrency)
+        return self.pool.map(function, pages)
 
-    def images_count (self):
+    def images_count (self, priority = INTERACTIVE):
         """ Get the total number of images in user's account """
-        r = self.api_request('account/images_count.json')
+        r = self.api_request('account/images_count.json', priority = priority)
         result = simplejson.loads(r)
         self.count = result['images_count']['count']
         return self.count
 
-    def image_list (self, album):
+    def fetch_pages (self, url, parameters, total, key, field, known = None,
+                     priority = INTERACTIVE):
+        """ Fetch every page of a listing, page_size items per page
+
+            If a set of known keys is given, stop after the first page with
+            a known item. Listings are newest first, so everything after it
+            is already in the index
+            Returns the items and the number of pages fetched
+        """
+        def fetch (i):
+            r = self.api_request(url + '?' + urllib.urlencode(dict(parameters,
+                                                                   page = i,
+                                                                   count = self.page_size)),
+                                 priority = priority)
+            if field in r:
+                return simplejson.loads(r)[field]
+            return []
+
+        items = []
+        pages = total/self.page_size + 1
+        # Pages start from 1
+        if known == None:
+            # Full listing, no reason to wait for one page before the next
+            for page in self.map_pages(fetch, range(1, pages + 1)):
+                items.extend(page)
+            return items, pages
+
+        for i in xrange(1, pages + 1):
+            page = fetch(i)
+            items.extend(page)
+            if [item for item in page if key(item) in known]:
+                return items, i
+        return items, pages
+
+    def is_incremental (self, listing_key, cached):
+        """ Whether a refresh of listing_key can stop at known items
+            A listing loaded from the index snapshot counts as reconciled
+        """
+        if cached == None or listing_key in self.unreconciled:
+            return False
+        reconciled = self.reconciled.setdefault(listing_key, time.time())
+        return time.time() - reconciled < self.reconcile_interval
+
+    def record_refresh (self, listing_key, fetched, total, incremental, complete):
+        """ Keep stats of a refresh, and schedule a full refresh if the
+            merged listing doesn't match the count imgur reports
+            (something was deleted)
+        """
+        pages = total/self.page_size + 1
+        self.refresh_stats[listing_key] = dict(fetched = fetched,
+                                               saved = pages - fetched)
+        if not incremental:
+            self.reconciled[listing_key] = time.time()
+            self.unreconciled.discard(listing_key)
+        elif not complete:
+            self.unreconciled.add(listing_key)
+        log.info('Refreshed %s: fetched %d pages, saved %d', listing_key, fetched,
+                 pages - fetched)
+
+    def image_list (self, album, priority = INTERACTIVE):
         """ Returns the images in a user's account as a dictionary 
-            The dictionary key is the image hash given by imgur
+            The dictionary key is the image name
 
             None album will return unorganized images
 
-            The value of each key is another dictionary with the parameters:
+            The value of each key is an ImageRecord with the fields:
             hash, size, type, datetime, deletehash, link
         """
 
-        # If the album list is in cache and 
-        # it's not expired, don't fetch it again
-        if album in self.cache and time.time() - self.cache[album]['time'] < 100:
-            print 'Using cache'
-            return self.cache[album]['images']
-        self.cache[album] = {'images': {}, 'time': 0}
+        # If the listing is in the index, return it right away and
+        # refresh it in the background if it's expired
+        cached = self.index.images(album)
+        if cached != None:
+            if not self.refresher.is_fresh(album, self.index.listing_time(album)):
+                metrics.incr('listings.stale')
+                self.refresher.schedule(album)
+            return cached
+        # Concurrent misses on the same album share one refresh
+        try:
+            return self.flights.do(album, self.refresh_images, album, priority)
+        except Offline:
+            # Nothing we know of
+            return {}
+
+    def refresh_images (self, album, priority = INTERACTIVE):
+        """ Fetch the images of album and store them in the index """
+        cached = self.index.images(album)
+        listing = {}
         images = []
 
         if album == None:
-            # Images start from page 1
-            for i in xrange(1, self.images_count()/100 + 2):
-                r = self.api_request('account/images.json?' + 
-                                     urllib.urlencode({'page' : i, 
-                                                       'count' : 100, 
-                                                       'noalbum': 'true'}))
-                if 'images' in r:
-                    images.extend(simplejson.loads(r)['images'])
+            total = self.images_count(priority)
+            known = None
+            if self.is_incremental(album, cached):
+                listing = dict(cached)
+                known = set(record.hash for record in cached.itervalues())
+            images, fetched = self.fetch_pages('account/images.json',
+                                               {'noalbum': 'true'}, total,
+                                               lambda i: i['image']['hash'],
+                                               'images', known, priority)
         else:
+            if album not in self.album_list(priority = priority):
+                return {}
             try:
                 r = self.api_request('account/albums/' + 
-                                     self.cache_albums['list'][album]['id'] +
-                                     '.json')
+                                     self.album_list()[album]['id'] +
+                                     '.json', priority = priority)
                 if 'albums' in r:
                     images.extend(simplejson.loads(r)['albums'])
             except urllib2.HTTPError:
                 return {}
 
         for i in images:
-            extension = '.' + i['image']['type'].split('/')[1]
-            name = i['image']['name'] or i['image']['hash']
-            name = str(name + extension) # Fuse doesn't like unicode
-            self.cache[album]['images'][name] = dict(hash = i['image']['hash'],
-                                            size = i['image']['size'],
-                                            type = i['image']['type'],
-                                            datetime = i['image']['datetime'],
-                                            deletehash = i['image']['deletehash'],
-                                            link = i['links']['original'])
-        self.cache[album]['time'] = time.time()
-        return self.cache[album]['images']
-
-    def albums_count (self):
+            name, record = self.make_record(i)
+            listing[name] = record
+        if album == None:
+            self.record_refresh(album, fetched, total, known != None,
+                                len(listing) == total)
+        if cached != None:
+            self.refresher.changed(album, set(cached) != set(listing))
+        self.index.set_images(album, listing, time.time())
+        return listing
+
+    def make_record (self, i):
+        """ Return the name and ImageRecord of an image as the api
+            describes it """
+        extension = '.' + i['image']['type'].split('/')[1]
+        name = i['image']['name'] or i['image']['hash']
+        name = str(name + extension) # Fuse doesn't like unicode
+        return name, ImageRecord(i['image']['hash'],
+                                 i['image']['size'],
+                                 i['image']['type'],
+                                 i['image']['datetime'],
+                                 i['image']['deletehash'],
+                                 i['links']['original'])
+
+    def albums_count (self, priority = INTERACTIVE):
         """ Get the total number of albums in user's account """
-        r = self.api_request('account/albums_count.json')
+        r = self.api_request('account/albums_count.json', priority = priority)
         result = simplejson.loads(r)
         self.album_count = result['albums_count']['count']
         return self.album_count
 
-    def album_list (self, use_cache = True):
+    def album_list (self, use_cache = True, priority = INTERACTIVE):
         """ Get the list of albums in a user's account """
-        if 'list' in self.cache_albums and time.time() - self.cache_albums['time'] < 100 and use_cache:
-            return self.cache_albums['list']
-        albums = []
-        self.cache_albums['list'] = {}
+        if not use_cache:
+            return self.refresh_albums(priority)
+        fetched = self.index.albums_time()
+        if fetched:
+            if not self.refresher.is_fresh('/', fetched):
+                metrics.incr('listings.stale')
+                self.refresher.schedule('/')
+            return self.index.album_list()
+        try:
+            return self.flights.do('/', self.refresh_albums, priority)
+        except Offline:
+            return self.index.album_list()
+
+    def refresh_albums (self, priority = INTERACTIVE):
+        """ Fetch the album list and store it in the index """
+        listing = {}
+        known = None
+        cached = self.index.album_list()
+        if not self.index.albums_time():
+            cached = None
 
-        for i in xrange(1, self.albums_count()/100 + 2):
-            r = self.api_request('account/albums.json?' + 
-                                 urllib.urlencode({'page' : i, 
-                                                   'count' : 100}))
-            albums.extend(simplejson.loads(r)['albums'])
+        total = self.albums_count(priority)
+        if self.is_incremental('/', cached):
+            listing = dict(cached)
+            known = set(record.id for record in cached.itervalues())
+        albums, fetched = self.fetch_pages('account/albums.json', {}, total,
+                                           lambda i: i['id'], 'albums', known,
+                                           priority)
 
         for i in albums:
             name = i['title'] or i['id']
             name = str(name) # Fuse doesn't like unicode
-            self.cache_albums['list'][name] = dict(id = i['id'], datetime = i['datetime'])
+            listing[name] = AlbumRecord(i['id'], i['datetime'])
 
-        self.cache_albums['time'] = time.time()
-        return self.cache_albums['list']
+        self.record_refresh('/', fetched, total, known != None,
+                            len(listing) == total)
+        if cached != None:
+            self.refresher.changed('/', set(cached) != set(listing))
+        self.index.set_albums(listing, time.time())
+        return listing
 
-    def upload_image (self, album, name, data):
-        """ Uploads an image to Imgur """
-        print "Trying to upload ", album, name
+    def upload_image (self, album, name, data, sha1 = None):
+        """ Uploads an image to Imgur
+            data is a file-like object, len(data) gives its size
+            If sha1 of the data is given and we know an image with that
+            content, it is put into album instead of uploaded again
+            Returns the ImageRecord of the new image, False if imgur
+            refused it
+        """
+        log.debug('uploading %s %s', album, name)
+        if sha1 != None:
+            record = self.link_image(album, name, sha1)
+            if record != None:
+                return record
         if len(data):
             try:
+                # The body is base64 encoded while it is sent, so the
+                # whole image is never in memory
                 r = self.api_request('account/images.json', 
-                                     dict(name=name, 
-                                          image=b64encode(data), 
-                                          type='base64'))
+                                     Base64Multipart(dict(name=name, 
+                                                          type='base64'),
+                                                     'image', data),
+                                     priority = UPLOAD)
             except urllib2.HTTPError, e:
                 error = simplejson.loads(e.readline())
                 if 'error' in error:
-                    print error['error']['message']
+                    log.warning('Uploading %s failed: %s', name,
+                                error['error']['message'])
                     return False
+            metrics.incr('bytes.uploaded', len(data))
             r = simplejson.loads(r)
-            if 'images' in r:
-                if album != None:
-                    imagehash = r['images']['image']['hash']
-                    self.add_images(album, [imagehash])
-            else:
-                print 'Something went wrong uploading the image'
+            if 'images' not in r:
+                log.warning('Uploading %s failed: %s', name, r)
                 return False
+            # Listings are refreshed in the background, show the
+            # image where it was written until then
+            listed_name, record = self.make_record(r['images'])
+            self.index.add_image(album, listed_name, record)
+            if sha1 != None:
+                self.index.add_digest(sha1, record)
+            if album != None:
+                if self.batcher != None:
+                    self.batcher.add(album, record.hash)
+                else:
+                    self.add_images(album, [record.hash])
+            return record
         return True
 
+    def link_image (self, album, name, sha1):
+        """ Put the image with content sha1 into album, if we know one
+            Returns its ImageRecord, None if it has to be uploaded: the
+            content is unknown, linking failed, the image is in album
+            under another name already, or it is in an album and album
+            is None (imgur can't take it out of there)
+        """
+        # Listed before anything is uploaded, so the index shows the
+        # image under its name until imgur lists it
+        listing = self.image_list(album, priority = UPLOAD)
+        record = self.index.by_hash(self.index.digest_hash(sha1))
+        if record == None:
+            return None
+        listed = [n for n, r in listing.iteritems() if r.hash == record.hash]
+        # Listings add the extension to the name it was uploaded with
+        if name in listed or name + '.' + record.type.split('/')[1] in listed:
+            # Written again with the same content
+            metrics.incr('dedup.skipped')
+            return record
+        queued = self.batcher != None and self.batcher.queued(album) or []
+        if listed or record.hash in queued:
+            # A copy under another name, an album holds an image only
+            # once, so it needs an image of its own
+            return None
+        if album == None:
+            return None
+        try:
+            self.add_images(album, [record.hash])
+        except Offline:
+            raise
+        except Exception, e:
+            # The image may be gone from imgur
+            log.info('Linking %s to %s failed, uploading it: %s', name,
+                     record.hash, e)
+            return None
+        # Shown under the name it was written as until the next refresh
+        self.index.add_image(album, name, record)
+        self.index.expire(album)
+        metrics.incr('dedup.linked')
+        metrics.incr('bytes.deduplicated', record.size)
+        return record
+
     def create_album (self, album):
         """ Add a new album """
         self.api_request('account/albums.json', dict(title=album))
@@ -197,6 +499,6 @@ class Imgur:
 
     def add_images (self, album, hashes):
         """ Move an image into an album """
-        album_hash = self.cache_albums['list'][album]['id']
+        album_hash = self.album_list()[album]['id']
         self.api_request('account/albums/' + album_hash + '.json', 
-                         dict(add_images = ','.join(hashes)))
+                         dict(add_images = ','.join(hashes)), UPLOAD)
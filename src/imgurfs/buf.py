@@ -20,58 +20,409 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #=======================================================================
 
-import urllib2
+import os
+import re
 import errno
-from cStringIO import StringIO
+import hashlib
+import tempfile
+import threading
+from sync import KeyedLock
+from metrics import metrics
+
+class SparseImage:
+    """ An image that is downloaded piece by piece with HTTP range requests
+
+        Data is kept in fixed size chunks, so a read only waits for the
+        chunks it covers. Sequential reads grow a read-ahead window
+    """
+    chunk_size = 64 * 1024
+    # Upper limit of read-ahead, in chunks
+    max_window = 16
+
+    def __init__ (self, link, size, http):
+        self.http = http
+        self.link = link
+        self.size = size
+        self.chunks = {}
+        self.window = 1
+        self.next_offset = 0
+
+    def chunk_count (self):
+        return (self.size + self.chunk_size - 1) / self.chunk_size
+
+    def complete (self):
+        """ True once every chunk of the image has arrived """
+        return len(self.chunks) >= self.chunk_count()
+
+    def data (self):
+        """ Return the whole image, only valid once complete() """
+        return ''.join(self.chunks[i] for i in xrange(self.chunk_count()))
+
+    def fetch (self, first, last):
+        """ Download chunks first to last (inclusive) in one request """
+        start = first * self.chunk_size
+        end = min((last + 1) * self.chunk_size, self.size) - 1
+        r = self.http.request(self.link,
+                              headers = {'Range': 'bytes=%d-%d' % (start, end)})
+        data = r.read()
+        metrics.incr('bytes.downloaded', len(data))
+
+        if r.getcode() == 206:
+            # Content-Range: bytes start-end/total
+            match = re.search(r'/(\d+)$', r.info().getheader('content-range', ''))
+            if match:
+                self.size = int(match.group(1))
+        else:
+            # Server ignored the range and sent the whole image
+            start = 0
+            self.size = len(data)
+            self.chunks = {}
+
+        for i in xrange(0, len(data), self.chunk_size):
+            self.chunks[(start + i) / self.chunk_size] = data[i:i+self.chunk_size]
+
+    def read (self, length, offset):
+        """ Return length bytes from offset, fetching missing chunks """
+        if offset >= self.size or length <= 0:
+            return ''
+
+        # Grow the read-ahead window while reads stay sequential
+        if offset == self.next_offset:
+            self.window = min(self.window * 2, self.max_window)
+        else:
+            self.window = 1
+        self.next_offset = offset + length
+
+        first = offset / self.chunk_size
+        last = (min(offset + length, self.size) - 1) / self.chunk_size
+        ahead = min(last + self.window - 1, self.chunk_count() - 1)
+
+        # Fetch each run of missing chunks with a single request
+        i = first
+        while i <= ahead:
+            if i in self.chunks:
+                i += 1
+                continue
+            j = i
+            while j + 1 <= ahead and j + 1 not in self.chunks:
+                j += 1
+            self.fetch(i, j)
+            if self.complete():
+                break
+            i = j + 1
+
+        data = ''.join(self.chunks[i] for i in xrange(first, last + 1)
+                       if i in self.chunks)
+        skip = offset - first * self.chunk_size
+        return data[skip:skip+length]
+
+class WriteBuffer:
+    """ Data of an image being written
+
+        Kept in memory until Buffer decides there's too much in memory
+        overall, then spilled to a temporary file. The size is tracked as
+        data comes in
+    """
+
+    def __init__ (self, directory = None):
+        # max_size 0 never rolls over by itself, spill() does it
+        self.file = tempfile.SpooledTemporaryFile(dir = directory)
+        self.size = 0
+        self.spilled = False
+        # Set once it was handed to the upload queue, which closes it
+        self.queued = False
+        self.lock = threading.Lock()
+
+    def write (self, data, offset):
+        """ Write data at offset, returns by how much the buffer grew
+            and whether it is still in memory """
+        with self.lock:
+            self.file.seek(offset)
+            self.file.write(data)
+            grown = max(offset + len(data) - self.size, 0)
+            self.size += grown
+            return grown, not self.spilled
+
+    def spill (self):
+        """ Move the data to disk, returns how many bytes left memory """
+        with self.lock:
+            if self.spilled:
+                return 0
+            self.file.rollover()
+            self.spilled = True
+            return self.size
+
+    def read (self, offset, length):
+        """ None once the buffer was closed """
+        with self.lock:
+            if self.file.closed:
+                return None
+            self.file.seek(offset)
+            return self.file.read(length)
+
+    def digest (self):
+        """ Hex sha1 of the data """
+        sha1 = hashlib.sha1()
+        with self.lock:
+            self.file.seek(0)
+            while True:
+                data = self.file.read(64 * 1024)
+                if not data:
+                    return sha1.hexdigest()
+                sha1.update(data)
+
+    def close (self):
+        """ Drop the data, returns how many bytes left memory """
+        with self.lock:
+            self.file.close()
+            if self.spilled:
+                return 0
+            self.spilled = True
+            return self.size
+
+class WriteBufferReader:
+    """ Read only file-like view of a WriteBuffer with its own position,
+        len() is the size of the whole buffer """
+
+    def __init__ (self, buffer):
+        self.buffer = buffer
+        self.offset = 0
+
+    def __len__ (self):
+        return self.buffer.size
+
+    def seek (self, offset):
+        self.offset = offset
+
+    def read (self, size = -1):
+        if size < 0:
+            size = self.buffer.size - self.offset
+        data = self.buffer.read(self.offset, size)
+        self.offset += len(data)
+        return data
+
+class FileReader:
+    """ File-like reader over a file to upload, len() is its size """
+
+    def __init__ (self, path):
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+
+    def __len__ (self):
+        return self.size
+
+    def read (self, size = -1):
+        return self.file.read(size)
+
+    def seek (self, offset):
+        self.file.seek(offset)
+
+    def close (self):
+        self.file.close()
 
 class Buffer:
     """ Manages buffers for reading and writing images from/to imgur """
 
-    def __init__ (self):
+    # Imgur doesn't allow files greater than 10 MB
+    max_image_size = 1024*1024*10
+
+    def __init__ (self, cache, http, memory_limit = 64*1024*1024, spool_dir = None,
+                  index = None):
+        # Read buffers are mmaps of files in the disk cache,
+        # keyed by image hash, with the number of open handles
+        self.cache = cache
+        self.http = http
+        # The disk cache is keyed by the sha1 of the content, index
+        # knows the sha1 of images we had before. Without an index,
+        # images are cached by hash
+        self.index = index
         self.read_images = {}
         self.write_images = {}
+        # Write buffers spill to files in spool_dir once all of them
+        # together hold more than memory_limit bytes
+        self.memory = 0
+        self.memory_limit = memory_limit
+        self.spool_dir = spool_dir
+        if spool_dir and not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir)
+        # Guards the structure of read_images and write_images and
+        # the memory count, never held during I/O
+        self.lock = threading.Lock()
+        # Per image locks, held while filling or reading a buffer
+        self.read_locks = KeyedLock()
 
-    def read (self, link, length, offset):
-        """ Download the image data to a buffer to manage reads """
-        if link not in self.read_images:
-            # Read the image into a buffer
-            self.read_images[link] = dict(buffer = urllib2.urlopen(link).read())
-        if offset > len(self.read_images[link]['buffer']):
-            return None
-        return self.read_images[link]['buffer'][offset:offset+length]
+    def open_read (self, image):
+        """ Register an open handle on image, so a release by another
+            reader doesn't drop the buffer under us """
+        with self.lock:
+            entry = self.read_images.setdefault(image['hash'],
+                                                dict(buffer = None, users = 0))
+            entry['users'] += 1
+
+    def read (self, image, length, offset):
+        """ Serve a read from the disk cache
+            On a miss, only the requested range is downloaded, the image
+            moves to the disk cache once all of it has arrived
+        """
+        key = image['hash']
+        with self.lock:
+            entry = self.read_images.setdefault(key, dict(buffer = None, users = 0))
+
+        with self.read_locks(key):
+            if entry['buffer'] is None:
+                cached = self.cached(image)
+                entry['buffer'] = cached and self.cache.get(cached)
+                metrics.incr(entry['buffer'] is None and 'cache.misses' or 'cache.hits')
+            if entry['buffer'] is None:
+                entry['buffer'] = SparseImage(image['link'], image['size'], self.http)
+
+            data = entry['buffer']
+            if isinstance(data, SparseImage):
+                if offset > data.size:
+                    return None
+                result = data.read(length, offset)
+                if data.complete():
+                    entry['buffer'] = self.cache.get(self.store(image, data.data()))
+                return result
+
+            if offset > len(data):
+                return None
+            return data[offset:offset+length]
+
+    def cached (self, image):
+        """ Key of image in the disk cache, None if it isn't there
+            Images from before the cache was keyed by content are
+            still found under their hash
+        """
+        sha1 = self.index != None and self.index.content_digest(image['hash'])
+        if sha1 and sha1 in self.cache:
+            return sha1
+        if image['hash'] in self.cache:
+            return image['hash']
+        return None
+
+    def store (self, image, data):
+        """ Put the downloaded content of image into the disk cache,
+            where images with the same content share one copy.
+            Returns its key """
+        if self.index == None:
+            self.cache.put(image['hash'], data)
+            return image['hash']
+        sha1 = hashlib.sha1(data).hexdigest()
+        if sha1 in self.cache:
+            metrics.incr('cache.shared')
+        else:
+            self.cache.put(sha1, data)
+        self.index.add_digest(sha1, image)
+        return sha1
+
+    def is_cached (self, image):
+        """ Whether image is in the disk cache """
+        return self.cached(image) != None
 
-    def clear_read (self, link):
-        """ Clear download buffer from memory """
-        if link in self.read_images:
-            self.read_images.pop(link)
+    def fetch (self, image):
+        """ Download the whole image into the disk cache, unless it's
+            there already. Returns the number of bytes downloaded """
+        with self.read_locks(image['hash']):
+            if self.cached(image) != None:
+                return 0
+            data = self.http.request(image['link']).read()
+            metrics.incr('bytes.downloaded', len(data))
+            self.store(image, data)
+            return len(data)
+
+    def clear_read (self, image):
+        """ Drop the mapping of a downloaded image once the last handle
+            on it is released, it stays on disk """
+        with self.lock:
+            entry = self.read_images.get(image['hash'])
+            if entry == None:
+                return
+            entry['users'] -= 1
+            if entry['users'] > 0:
+                return
+            self.read_images.pop(image['hash'])
+        with self.read_locks(image['hash']):
+            if hasattr(entry['buffer'], 'close'):
+                entry['buffer'].close()
+            # A reader that got hold of the entry before we popped it
+            # will map the image again
+            entry['buffer'] = None
 
     def create (self, album, name):
-        """ Initialize a StringIO object for our new image 
+        """ Initialize a WriteBuffer for our new image 
             in album (image upload is asynchronous) """
-        if album not in self.write_images:
-            self.write_images[album] = {}
-        self.write_images[album][name] = {'data' : StringIO()}
+        buffer = WriteBuffer(self.spool_dir)
+        with self.lock:
+            if album not in self.write_images:
+                self.write_images[album] = {}
+            old = self.write_images[album].get(name)
+            self.write_images[album][name] = {'data' : buffer}
+        # A queued buffer is still being uploaded, the queue closes it
+        if old != None and not old['data'].queued:
+            self.close_write(old['data'])
 
     def write (self, album, name, data, offset):
         """ Write data to an image """
-        f = self.write_images[album][name]['data']
-        f.seek(offset)
-        f.write(data)
-
-        # Imgur doesn't allow files greater than 10 MB
-        if len(f.getvalue()) > 1024*1024*10:
-            f.truncate(0)
+        buffer = self.write_images[album][name]['data']
+        if offset + len(data) > self.max_image_size:
             return - errno.EFBIG
+
+        grown, in_memory = buffer.write(data, offset)
+        if in_memory and grown:
+            with self.lock:
+                self.memory += grown
+                spill = self.memory > self.memory_limit
+            if spill:
+                spilled = buffer.spill()
+                with self.lock:
+                    self.memory -= spilled
         return len(data)
 
-    def get_data (self, album, name):
-        """ Return data for the image to be uploaded """
-        f = self.write_images[album][name]['data']
-        return f.getvalue()
+    def has_write (self, album, name):
+        """ Whether name in album is being written or waiting for upload """
+        return name in self.write_images.get(album, ())
+
+    def read_write (self, album, name, length, offset):
+        """ Serve a read from the WriteBuffer of an image that is
+            being written or waiting for upload. None if there is none
+            anymore, the image was uploaded meanwhile
+        """
+        with self.lock:
+            entry = self.write_images.get(album, {}).get(name)
+        if entry == None:
+            return None
+        return entry['data'].read(offset, length)
+
+    def get_size (self, album, name):
+        """ Size of an image that is being written """
+        return self.write_images[album][name]['data'].size
+
+    def detach (self, album, name):
+        """ Hand the WriteBuffer of a closed image over for upload
+            It stays visible until clear_write(), a rewrite gets a new
+            buffer meanwhile. Returns None if it was handed over already
+        """
+        with self.lock:
+            entry = self.write_images.get(album, {}).get(name)
+            if entry == None or entry['data'].queued:
+                return None
+            entry['data'].queued = True
+            return entry['data']
+
+    def clear_write (self, album, name, buffer):
+        """ Drop buffer once it was uploaded, the image stops being
+            listed unless it was rewritten meanwhile """
+        with self.lock:
+            entry = self.write_images.get(album, {}).get(name)
+            if entry != None and entry['data'] is buffer:
+                del self.write_images[album][name]
+        self.close_write(buffer)
 
-    def clear_write (self, album, name):
-        """ Clear write buffer from memory """
-        self.write_images[album].pop(name)
+    def close_write (self, buffer):
+        freed = buffer.close()
+        with self.lock:
+            self.memory -= freed
 
     def buffered_write_list (self, album):
         """ Get the list of images that are in the queue to being uploaded
@@ -79,6 +430,6 @@ class Buffer:
             otherwise fails
         """
         if album in self.write_images:
-            return self.write_images[album].keys()
+            return list(self.write_images[album])
         else:
             return []
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#=======================================================================
+#  imgurfs - Virtual file system for Imgur
+#  cache.py - Persistent on-disk cache for image contents
+#  Copyright (c) 2012 Gaganpreet  <gaganpreet.arora@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import os
+import mmap
+import tempfile
+import threading
+from collections import OrderedDict
+
+class DiskCache:
+    """ Keeps downloaded images on disk, keyed by the sha1 of their
+        content, so images with the same content are stored once
+
+        The cache survives remounts. Once the total size goes over
+        max_size bytes, least recently used images are evicted
+    """
+
+    def __init__ (self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        # Key -> size in bytes, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        # Guards entries and size, file I/O happens outside of it
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.load()
+
+    def load (self):
+        """ Index images left over from earlier mounts
+            The modification time is bumped on every access, so it
+            gives us the LRU order back
+        """
+        files = []
+        for key in os.listdir(self.directory):
+            # Skip half written files from an earlier crash
+            if key.startswith('.'):
+                continue
+            st = os.stat(self.path(key))
+            files.append((st.st_mtime, key, st.st_size))
+
+        for mtime, key, size in sorted(files):
+            self.entries[key] = size
+            self.size += size
+        self.evict()
+
+    def path (self, key):
+        """ Location of the cached image on disk """
+        return os.path.join(self.directory, key)
+
+    def __contains__ (self, key):
+        return key in self.entries
+
+    def get (self, key):
+        """ Return a read only mmap of the cached image, or None on a miss
+            Empty images are returned as an empty string since they can't
+            be mapped
+        """
+        with self.lock:
+            if key not in self.entries:
+                return None
+            size = self.entries[key] = self.entries.pop(key)
+        self.touch(key)
+        if size == 0:
+            return ''
+        try:
+            f = open(self.path(key), 'rb')
+        except IOError:
+            # Somebody cleaned the cache directory under us
+            with self.lock:
+                if key in self.entries:
+                    self.size -= self.entries.pop(key)
+            return None
+        try:
+            return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+    def put (self, key, data):
+        """ Store image data in the cache and evict old images if needed """
+        fd, tmp = tempfile.mkstemp(prefix = '.', dir = self.directory)
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmp, self.path(key))
+
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)
+            self.entries[key] = len(data)
+            self.size += len(data)
+        self.evict()
+
+    def touch (self, key):
+        """ Bump the modification time, it gives the LRU order back
+            on the next mount """
+        try:
+            os.utime(self.path(key), None)
+        except OSError:
+            pass
+
+    def evict (self):
+        """ Remove least recently used images until we are within budget
+            The most recent image is always kept, even if it's too big
+        """
+        while True:
+            with self.lock:
+                if self.size <= self.max_size or len(self.entries) < 2:
+                    return
+                key, size = self.entries.popitem(last = False)
+                self.size -= size
+            try:
+                os.unlink(self.path(key))
+            except OSError:
+                pass
@@ -0,0 +1,285 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#=======================================================================
+#  imgurfs - Virtual file system for Imgur
+#  conn.py - Pooled keep-alive HTTP connections
+#  Copyright (c) 2012 Gaganpreet  <gaganpreet.arora@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import os
+import uuid
+import socket
+import httplib
+import base64
+import urllib2
+import urlparse
+import cookielib
+import tempfile
+import threading
+from cStringIO import StringIO
+
+class Response:
+    """ A completely read HTTP response, mostly compatible with what
+        urllib2.urlopen returns """
+
+    def __init__ (self, url, code, msg, headers, body):
+        self.url = url
+        self.code = code
+        self.msg = msg
+        self.headers = headers
+        self.fp = StringIO(body)
+
+    def getcode (self):
+        return self.code
+
+    def info (self):
+        return self.headers
+
+    def read (self, size = -1):
+        return self.fp.read(size)
+
+    def readline (self):
+        return self.fp.readline()
+
+class CookieResponse:
+    """ What cookielib needs to extract cookies from a response """
+
+    def __init__ (self, headers):
+        self.headers = headers
+
+    def info (self):
+        return self.headers
+
+class ConnectionPool:
+    """ Keeps connections open between requests and reuses them
+
+        At most max_per_host connections are open to a host at a time,
+        requests over that wait for a connection to be free. Cookies are
+        kept like urllib2.HTTPCookieProcessor does, and loaded from and
+        saved to cookie_file if given, so a session outlives the mount
+    """
+    max_redirects = 5
+
+    def __init__ (self, max_per_host = 4, timeout = 60, cookie_file = None):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.cookie_file = cookie_file
+        self.cookies = cookielib.LWPCookieJar()
+        if cookie_file and os.path.exists(cookie_file):
+            try:
+                # Session cookies too, they are what we save them for
+                self.cookies.load(cookie_file, ignore_discard = True)
+            except (IOError, cookielib.LoadError):
+                pass
+        self.lock = threading.Lock()
+        # (scheme, host, port) -> idle connections
+        self.idle = {}
+        # (scheme, host, port) -> semaphore limiting open connections
+        self.slots = {}
+        self.stats = dict(requests = 0, created = 0, reused = 0)
+        # Optional offline.Connectivity told how requests went
+        self.connectivity = None
+
+    def request (self, url, data = None, headers = {}, method = None):
+        """ Make a request and return a Response
+            Raises urllib2.HTTPError for error statuses, and Offline
+            without trying while imgur is known to be unreachable
+        """
+        connectivity = self.connectivity
+        if connectivity != None:
+            connectivity.check()
+        for i in xrange(self.max_redirects + 1):
+            try:
+                response = self.send(url, data, headers, method)
+            except (httplib.HTTPException, socket.error):
+                if connectivity != None:
+                    connectivity.failure()
+                raise
+            if connectivity != None:
+                if response.code >= 500:
+                    connectivity.failure()
+                else:
+                    connectivity.success()
+            location = response.headers.getheader('location')
+            if response.code not in (301, 302, 303, 307) or not location:
+                break
+            url = urlparse.urljoin(url, location)
+            if response.code != 307:
+                data = None
+                method = None
+
+        if response.code >= 400:
+            raise urllib2.HTTPError(url, response.code, response.msg,
+                                    response.headers, response.fp)
+        return response
+
+    def send (self, url, data, headers, method):
+        """ Send a single request over a pooled connection """
+        request = urllib2.Request(url, data, headers)
+        self.cookies.add_cookie_header(request)
+        headers = dict(request.header_items())
+        if data != None and 'Content-type' not in headers:
+            headers['Content-type'] = 'application/x-www-form-urlencoded'
+        if method == None:
+            method = data == None and 'GET' or 'POST'
+
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        key = (parts.scheme, parts.hostname,
+               parts.port or (parts.scheme == 'https' and 443 or 80))
+
+        slot = self.slot(key)
+        slot.acquire()
+        try:
+            conn, reused = self.checkout(key)
+            try:
+                conn.request(method, path, data, headers)
+                r = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                # The server may have closed an idle connection,
+                # retry once on a fresh one
+                if not reused:
+                    raise
+                if hasattr(data, 'read'):
+                    data.rewind()
+                conn, reused = self.connect(key), False
+                conn.request(method, path, data, headers)
+                r = conn.getresponse()
+
+            body = r.read()
+            if r.will_close:
+                conn.close()
+            else:
+                self.checkin(key, conn)
+        finally:
+            slot.release()
+
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats[reused and 'reused' or 'created'] += 1
+        self.cookies.extract_cookies(CookieResponse(r.msg), request)
+        return Response(url, r.status, r.reason, r.msg, body)
+
+    def save_cookies (self):
+        """ Write the cookies to cookie_file, readable only by us """
+        if not self.cookie_file:
+            return
+        directory = os.path.dirname(self.cookie_file)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # mkstemp makes the file private before anything is in it
+        fd, tmp = tempfile.mkstemp(prefix = '.', dir = directory)
+        os.close(fd)
+        self.cookies.save(tmp, ignore_discard = True)
+        os.rename(tmp, self.cookie_file)
+
+    def slot (self, key):
+        with self.lock:
+            if key not in self.slots:
+                self.slots[key] = threading.BoundedSemaphore(self.max_per_host)
+            return self.slots[key]
+
+    def checkout (self, key):
+        """ Return an idle connection to key or a new one, and whether
+            it was reused """
+        with self.lock:
+            if self.idle.get(key):
+                return self.idle[key].pop(), True
+        return self.connect(key), False
+
+    def checkin (self, key, conn):
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+    def connect (self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout = self.timeout)
+        return httplib.HTTPConnection(host, port, timeout = self.timeout)
+
+    def close (self):
+        """ Close all idle connections """
+        with self.lock:
+            for conns in self.idle.itervalues():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+class Base64Multipart:
+    """ multipart/form-data request body with one base64 encoded file
+        field, encoded a chunk at a time as the connection reads it
+
+        data is a file-like object, len(data) has to give its size, and
+        seek(0) has to work for rewind()
+    """
+    # Raw bytes encoded per chunk, a multiple of 3 so the chunks
+    # concatenate into valid base64
+    chunk_size = 48 * 1024
+
+    def __init__ (self, fields, field, data):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + self.boundary
+        head = ''
+        for name, value in fields.iteritems():
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            head += self.part_header(name) + str(value) + '\r\n'
+        head += self.part_header(field)
+        tail = '\r\n--%s--\r\n' % self.boundary
+
+        self.data = data
+        self.length = len(head) + (len(data) + 2) / 3 * 4 + len(tail)
+        self.head = head
+        self.end = tail
+        self.rewind()
+
+    def rewind (self):
+        """ Start the body over, to send it again """
+        self.data.seek(0)
+        self.buffer = self.head
+        self.leftover = ''
+        self.tail = self.end
+
+    def part_header (self, name):
+        return '--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n' % \
+               (self.boundary, name)
+
+    def __len__ (self):
+        return self.length
+
+    def read (self, size = -1):
+        """ Return up to size bytes of the body, '' at the end """
+        while size < 0 or len(self.buffer) < size:
+            raw = self.data.read(self.chunk_size)
+            if raw:
+                # Only encode whole 3 byte groups until the end, short
+                # reads would otherwise put padding mid-stream
+                raw = self.leftover + raw
+                cut = len(raw) - len(raw) % 3
+                self.buffer += base64.b64encode(raw[:cut])
+                self.leftover = raw[cut:]
+            else:
+                self.buffer += base64.b64encode(self.leftover) + self.tail
+                self.leftover = self.tail = ''
+                break
+        if size < 0:
+            size = len(self.buffer)
+        result, self.buffer = self.buffer[:size], self.buffer[size:]
+        return result
@@ -26,12 +26,27 @@ import getpass
 import time
 import stat
 import errno
-from datetime import datetime
+import json
+import logging
+import threading
 from buf import Buffer
 from api import Imgur
+from cache import DiskCache
+from conn import ConnectionPool
+from upload import UploadQueue, AlbumBatcher
+from prefetch import Prefetcher
+from refresh import Refresher
+from index import AlbumRecord, MetadataIndex
+from metrics import metrics, setup_logging
+from offline import Offline, Connectivity, Journal
 
 fuse.fuse_python_api = (0, 2)
 
+log = logging.getLogger('imgurfs.fs')
+
+# Hidden control file, reading it gives the metrics as JSON
+STATS_PATH = '/.imgurfs-stats'
+
 def split_path (path):
     """ Splits a path into album and name, no existence checks 
         If the path points to something in /, parent is None and child is the file/dir name
@@ -67,156 +82,415 @@ class ImgurFS (fuse.Fuse):
         """ Initialize the fuse filesystem 
             Note: run with -f parameter for debugging 
         """
-        self.buf = Buffer()
+        # Requests are served from multiple threads, -s gives back
+        # the single threaded mode
+        kw.setdefault('dash_s_do', 'setsingle')
         fuse.Fuse.__init__(self, *args, **kw)
-        username = raw_input('Imgur username/email: ')
-        password = getpass.getpass('Password: ')
-        self.imgur = Imgur(username, password)
-        print 'Logged in'
-
-    def parse_path(self, path):
-        """ Parses a path into album and image name
-            Possible inputs are:
-                /
-                /image_name (Belongs to None album)
-                /album_name
-                /album_name/image_name
-            Returns a list [album_name, image_name]
+        self.multithreaded = True
+        # All directories have the same attributes, dated at mount
+        self.dir_stat = Stat()
+        # Seconds from start to mounted, signed in, the first listing
+        # and the first readdir of /
+        self.started = time.time()
+        self.startup = {}
+
+        # Mount options, parse() overwrites these with -o values
+        self.cache_dir = os.path.expanduser('~/.cache/imgurfs')
+        self.cache_size = 512
+        self.concurrency = 4
+        self.connections = 4
+        self.write_memory = 64
+        self.kernel_cache_timeout = 30
+        self.missing_timeout = 30
+        self.prefetch = 0
+        self.prefetch_rate = 1024
+        self.upload_workers = 2
+        self.upload_retries = 3
+        self.unmount_wait = 60
+        self.refresh_min = 100
+        self.refresh_max = 1800
+        self.album_refresh = ''
+        self.api_endpoint = 'https://api.imgur.com/2/'
+        self.offline_after = 3
+        self.offline_retry = 30
+        self.log_level = ''
+        self.log_file = ''
+        self.username = ''
+        self.password_file = ''
+        self.parser.add_option(mountopt = 'cache_dir', metavar = 'PATH',
+                               default = self.cache_dir,
+                               help = 'directory for cached images [default: %default]')
+        self.parser.add_option(mountopt = 'cache_size', metavar = 'MB',
+                               type = 'int', default = self.cache_size,
+                               help = 'size limit of the image cache [default: %default]')
+        self.parser.add_option(mountopt = 'concurrency', metavar = 'N',
+                               type = 'int', default = self.concurrency,
+                               help = 'listing pages fetched in parallel [default: %default]')
+        self.parser.add_option(mountopt = 'connections', metavar = 'N',
+                               type = 'int', default = self.connections,
+                               help = 'keep-alive connections per host [default: %default]')
+        self.parser.add_option(mountopt = 'write_memory', metavar = 'MB',
+                               type = 'int', default = self.write_memory,
+                               help = 'memory for images being written, the rest goes to disk [default: %default]')
+        self.parser.add_option(mountopt = 'missing_timeout', metavar = 'SEC',
+                               type = 'int', default = self.missing_timeout,
+                               help = 'how long a path that was not found is remembered [default: %default]')
+        self.parser.add_option(mountopt = 'prefetch', metavar = 'N',
+                               type = 'int', default = self.prefetch,
+                               help = 'images to download ahead of reads in an album [default: %default]')
+        self.parser.add_option(mountopt = 'prefetch_rate', metavar = 'KB',
+                               type = 'int', default = self.prefetch_rate,
+                               help = 'bandwidth for prefetching, per second, 0 for no limit [default: %default]')
+        self.parser.add_option(mountopt = 'upload_workers', metavar = 'N',
+                               type = 'int', default = self.upload_workers,
+                               help = 'images uploaded in parallel [default: %default]')
+        self.parser.add_option(mountopt = 'upload_retries', metavar = 'N',
+                               type = 'int', default = self.upload_retries,
+                               help = 'retries of a failed upload [default: %default]')
+        self.parser.add_option(mountopt = 'unmount_wait', metavar = 'SEC',
+                               type = 'int', default = self.unmount_wait,
+                               help = 'how long unmount waits for queued uploads, the rest is journaled [default: %default]')
+        self.parser.add_option(mountopt = 'refresh_min', metavar = 'SEC',
+                               type = 'int', default = self.refresh_min,
+                               help = 'age at which listings are refreshed in the background [default: %default]')
+        self.parser.add_option(mountopt = 'refresh_max', metavar = 'SEC',
+                               type = 'int', default = self.refresh_max,
+                               help = 'longest refresh interval of listings that don\'t change [default: %default]')
+        self.parser.add_option(mountopt = 'album_refresh', metavar = 'NAME:SEC/...',
+                               default = self.album_refresh,
+                               help = 'fixed refresh intervals per album, . for images outside albums')
+        self.parser.add_option(mountopt = 'api_endpoint', metavar = 'URL',
+                               default = self.api_endpoint,
+                               help = 'imgur api to use, e.g. a mock server for benchmarks [default: %default]')
+        self.parser.add_option(mountopt = 'offline_after', metavar = 'N',
+                               type = 'int', default = self.offline_after,
+                               help = 'failed requests in a row before working offline [default: %default]')
+        self.parser.add_option(mountopt = 'offline_retry', metavar = 'SEC',
+                               type = 'int', default = self.offline_retry,
+                               help = 'how often to check whether imgur is back [default: %default]')
+        self.parser.add_option(mountopt = 'log_level', metavar = 'LEVEL',
+                               default = self.log_level,
+                               help = 'log debug, info, warning or error messages, off by default')
+        self.parser.add_option(mountopt = 'log_file', metavar = 'PATH',
+                               default = self.log_file,
+                               help = 'file to log to instead of stderr')
+        self.parser.add_option(mountopt = 'username', metavar = 'NAME',
+                               default = self.username,
+                               help = 'imgur username or email, asked for if not given')
+        self.parser.add_option(mountopt = 'password_file', metavar = 'PATH',
+                               default = self.password_file,
+                               help = 'file holding the imgur password')
+
+    def main (self, *args, **kw):
+        """ Get the credentials and enter the fuse loop, signing in
+            is left for later """
+        if self.log_level:
+            setup_logging(self.log_level, self.log_file)
+        if self.fuse_args.mount_expected():
+            username = self.username or os.environ.get('IMGURFS_USERNAME') or \
+                       raw_input('Imgur username/email: ')
+            password = os.environ.get('IMGURFS_PASSWORD')
+            if self.password_file:
+                with open(self.password_file) as f:
+                    password = f.read().strip()
+            self.setup(username, password)
+            if password == None and not self.imgur.session:
+                # No session saved by an earlier mount
+                self.imgur.password = getpass.getpass('Password: ')
+                self.started = time.time()
+
+        # Let the kernel cache attributes and lookups too, unless
+        # told otherwise on the command line
+        for option in ('attr_timeout', 'entry_timeout'):
+            if option not in self.fuse_args.optdict:
+                self.fuse_args.add(option, str(self.kernel_cache_timeout))
+        return fuse.Fuse.main(self, *args, **kw)
+
+    def setup (self, username, password):
+        """ Build the caches and workers the fuse calls use from the
+            options, without mounting anything or talking to imgur.
+            password can be None if a session was saved before
+        """
+        cache = DiskCache(os.path.join(self.cache_dir, 'images'),
+                          self.cache_size * 1024 * 1024)
+        http = ConnectionPool(self.connections,
+                              cookie_file = os.path.join(self.cache_dir, 'session',
+                                                         username + '.cookies'))
+        http.connectivity = Connectivity(http, self.api_endpoint,
+                                         self.offline_after, self.offline_retry)
+        index = MetadataIndex(os.path.join(self.cache_dir, 'metadata',
+                                           username + '.db'))
+        self.buf = Buffer(cache, http, self.write_memory * 1024 * 1024,
+                          os.path.join(self.cache_dir, 'spool'), index)
+        self.imgur = Imgur(username, password, index, http, self.api_endpoint)
+        self.imgur.concurrency = self.concurrency
+        self.imgur.batcher = AlbumBatcher(self.imgur)
+        self.imgur.refresher = Refresher(self.imgur, self.refresh_min,
+                                         self.refresh_max,
+                                         self.refresh_overrides())
+        # What was written offline, kept until imgur is back
+        self.journal = Journal(os.path.join(self.cache_dir, 'journal', username))
+        http.connectivity.on_online.append(lambda: self.journal.replay(self.imgur))
+        self.uploads = UploadQueue(self.imgur, self.buf,
+                                   self.upload_workers, self.upload_retries,
+                                   journal = self.journal)
+        self.prefetcher = Prefetcher(self.buf, self.imgur, self.prefetch,
+                                     self.prefetch_rate * 1024)
+
+        # What the other objects already keep track of, for STATS_PATH
+        imgur = self.imgur
+        metrics.gauge('ratelimit', lambda: imgur.ratelimit)
+        metrics.gauge('scheduler', lambda: dict(imgur.scheduler.stats,
+                                                waiting = imgur.scheduler.waiting))
+        metrics.gauge('refresh', lambda: dict(imgur.refresh_stats,
+                                              queued = len(imgur.refresher.queue)))
+        metrics.gauge('pool', lambda: http.stats)
+        metrics.gauge('cache', lambda: dict(bytes = cache.size,
+                                            images = len(cache.entries)))
+        metrics.gauge('write_memory', lambda: self.buf.memory)
+        metrics.gauge('uploads', lambda: dict(queued = self.uploads.queue.qsize(),
+                                              files = self.uploads.status()))
+        metrics.gauge('album_adds', imgur.batcher.status)
+        metrics.gauge('connectivity', lambda: http.connectivity.stats)
+        metrics.gauge('journal', lambda: len(self.journal.entries))
+        metrics.gauge('prefetch', lambda: dict(self.prefetcher.stats,
+                                               queued = len(self.prefetcher.queue)))
+        metrics.gauge('startup', lambda: dict(self.startup,
+                                              session = imgur.session,
+                                              signin_error = imgur.signin_error))
+
+    def stats (self):
+        """ Contents of STATS_PATH """
+        return json.dumps(metrics.snapshot(), indent = 2, sort_keys = True) + '\n'
+
+    def refresh_overrides (self):
+        """ Parse album_refresh into {album: seconds} """
+        overrides = {}
+        for item in self.album_refresh.split('/'):
+            if not item:
+                continue
+            album, seconds = item.rsplit(':', 1)
+            if album == '.':
+                album = None
+            overrides[album] = int(seconds)
+        return overrides
+
+    def lookup (self, path):
+        """ Returns the ImageRecord or AlbumRecord at path, None if there
+            is nothing there. / isn't in the index and gives None too
         """
-        # TODO: Try to write this function more concisely
-
         # Path can't have more than two slashes
         if path.count('/') > 2 or path == '/':
-            return [None, None]
-
+            return None
+        # Editors and file managers probe for the same missing files
+        # over and over, don't refresh listings for them
+        index = self.imgur.index
+        if index.is_missing(path):
+            metrics.incr('lookup.missing_hits')
+            return None
+
+        # Make sure the listings that could hold path are fresh,
+        # then it's a single lookup in the index
         relative_path = path[1:]
-        # Test for albums or images in /, paths with one slash
         if '/' not in relative_path:
-            if relative_path in self.imgur.image_list(None):
-                return [None, relative_path]
-            elif relative_path in self.imgur.album_list():
-                return [relative_path, None]
-            else:
-                return [None, None]
-
-        # Now deal paths with 2 slashes
+            self.imgur.image_list(None)
+            self.imgur.album_list()
         else:
-            album, name = relative_path.split('/')
-            if name in self.imgur.image_list(album):
-                return [album, name]
-            else:
-                return [None, None]
+            self.imgur.image_list(relative_path.split('/')[0])
+        record = index.lookup(path)
+        if record == None:
+            index.add_missing(path, self.missing_timeout)
+        return record
+
+    def file_stat (self, image):
+        """ Attributes of an image, built once and kept in its record """
+        if image.stat == None:
+            st = Stat()
+            st.st_mode = stat.S_IFREG | 0755
+            st.st_nlink = 1
+            st.st_ctime = st.st_mtime = st.st_atime = image.mtime
+            st.st_size = image.size
+            image.stat = st
+        return image.stat
 
+    @metrics.timed('fs.getattr')
     def getattr (self, path):
         """ Returns the attributes for the given path
-            Defaults are taken from Stat class defined above
+            Stats of images are precomputed, directories share one
         """
-        print '*** getattr', path
-        st = Stat()
+        log.debug('getattr %s', path)
+        if path == '/':
+            return self.dir_stat
+        if path == STATS_PATH:
+            st = Stat()
+            st.st_mode = stat.S_IFREG | 0444
+            st.st_nlink = 1
+            st.st_size = len(self.stats())
+            return st
 
-        print split_path(path)
         parent, child = split_path(path)
-        if child in self.buf.buffered_write_list(parent):
+        if self.buf.has_write(parent, child):
+            # Image that is being written or waiting for upload
+            st = Stat()
             st.st_mode = stat.S_IFREG | 0755
-            st.st_size = 0
+            st.st_size = self.buf.get_size(parent, child)
             return st
-
-        album, name = self.parse_path(path)
-
-        if name == None and album == None and path != '/':
+        if self.journal.entries:
+            # Written or created offline, not on imgur yet
+            if parent == None and child in self.journal.albums():
+                return self.dir_stat
+            size = self.journal.uploads(parent).get(child)
+            if size != None:
+                st = Stat()
+                st.st_mode = stat.S_IFREG | 0755
+                st.st_size = size
+                return st
+
+        record = self.lookup(path)
+        if record == None:
             return - errno.ENOENT
+        elif isinstance(record, AlbumRecord):
+            return self.dir_stat
+        return self.file_stat(record)
 
-        # Add more info if path is a file
-        if name != None: 
-            image = self.imgur.image_list(album)[name]
-            st.st_mode = stat.S_IFREG | 0755
-            st.st_ctime = time.mktime(datetime.strptime(image['datetime'], 
-                                      '%Y-%m-%d %H:%M:%S').timetuple())
-            st.st_mtime = st.st_ctime
-            st.st_size = image['size']
-        return st
-
+    @metrics.timed('fs.readdir')
     def readdir (self, path, offset):
-        """ Returns a generator for files in user's account """
-        print '*** readdir', path, offset
+        """ Returns the entries of a directory in user's account """
+        log.debug('readdir %s %s', path, offset)
         dirents = ['.', '..']
         parent, child = split_path(path)
         images = self.imgur.image_list(child)
         dirents.extend(images.keys())
+        self.prefetcher.after_readdir(child, images)
 
         if path == '/':
             albums = self.imgur.album_list()
             dirents.extend(albums.keys())
 
-        for d in dirents:
-            yield fuse.Direntry(d)
+        # Files waiting for upload and what was made offline
+        pending = self.buf.buffered_write_list(child) + \
+                  self.journal.uploads(child).keys()
+        if path == '/':
+            pending.extend(self.journal.albums())
+        known = set(dirents)
+        dirents.extend(name for name in set(pending) if name not in known)
+
+        if path == '/' and 'first_ls' not in self.startup:
+            self.mark('first_ls')
+        return [fuse.Direntry(d) for d in dirents]
 
+    @metrics.timed('fs.open')
     def open (self, path, flags):
         """ Open a file handler """
-        print '*** open', path, flags
+        log.debug('open %s %s', path, flags)
         accmode = os.O_RDONLY | os.O_WRONLY | os.O_RDWR 
         if (flags & accmode) not in [os.O_RDONLY, os.O_WRONLY]:
             return -errno.EACCES
+        if path == STATS_PATH:
+            if flags & accmode != os.O_RDONLY:
+                return -errno.EACCES
+            # The handle keeps the snapshot its reads come from,
+            # direct_io since its size changes between reads
+            return fuse.FuseFileInfo(direct_io = True, snapshot = self.stats())
+        image = self.imgur.index.lookup(path)
+        if image != None and not isinstance(image, AlbumRecord):
+            self.buf.open_read(image)
+            parent, child = split_path(path)
+            self.prefetcher.after_open(parent, child,
+                                       self.imgur.index.images(parent) or {})
+            # The handle remembers the image, so release drops the
+            # buffer it opened even if the listing changed meanwhile
+            return fuse.FuseFileInfo(image = image)
         return 0
     
-    def read (self, path, length, offset):
-        """ Read length bytes starting from offset and return """
-        print '*** read', path, length, offset
+    @metrics.timed('fs.read')
+    def read (self, path, length, offset, fh = None):
+        """ Read length bytes starting from offset and return
+            Images not uploaded yet are read from their write buffer
+        """
+        log.debug('read %s %s %s', path, length, offset)
+        if path == STATS_PATH:
+            snapshot = getattr(fh, 'snapshot', None)
+            if snapshot == None:
+                snapshot = self.stats()
+            return snapshot[offset:offset + length]
         parent, child = split_path(path)
-        image = self.imgur.image_list(parent)[child]
-        return self.buf.read(image['link'], length, offset)
+        if self.buf.has_write(parent, child):
+            data = self.buf.read_write(parent, child, length, offset)
+            if data != None:
+                return data
+        image = getattr(fh, 'image', None) or self.imgur.index.lookup(path)
+        if image == None or isinstance(image, AlbumRecord):
+            return - errno.ENOENT
+        return self.buf.read(image, length, offset)
 
-    def release (self, path, flags):
+    @metrics.timed('fs.release')
+    def release (self, path, flags, fh = None):
         """ release is called after either reading an image or writing one 
-            If an upload fails, there's no feedback (errno doesn't work for release?)
+            Written images are queued for upload in the background, errno
+            doesn't work for release so failures show up in
+            self.uploads.status()
         """
-        print '*** release', path, flags
+        log.debug('release %s %s', path, flags)
+        if path == STATS_PATH:
+            return 0
         parent, child = split_path(path)
 
-        if child in self.buf.buffered_write_list(parent):
-            result = self.imgur.upload_image(parent, child, self.buf.get_data(parent, child))
-            self.buf.clear_write(parent, child)
-            if result == False:
-                return - errno.ENOSYS
-        else:
-            image = self.imgur.image_list(parent)[child]
-            self.buf.clear_read(image['link'])
+        image = getattr(fh, 'image', None)
+        if image != None:
+            self.buf.clear_read(image)
+        elif flags & (os.O_WRONLY | os.O_RDWR) and \
+             self.buf.has_write(parent, child):
+            buffer = self.buf.detach(parent, child)
+            if buffer != None:
+                self.uploads.put(parent, child, buffer)
         return 0
 
+    @metrics.timed('fs.create')
     def create (self, path, flags, mode):
         """ Create a file with flags and mode """
-        print '*** create', path, flags, mode
+        log.debug('create %s %s %s', path, flags, mode)
         parent, child = split_path(path)
         if mode & stat.S_IFREG == 0:
             return - errno.ENOSYS
         self.buf.create(parent, child)
+        self.imgur.index.forget_missing(path)
         return 0
 
+    @metrics.timed('fs.write')
     def write (self, path, data, offset):
         """ Write data to create'ed file """
-        print '*** write', path, data, offset
+        log.debug('write %s %s bytes at %s', path, len(data), offset)
         parent, child = split_path(path)
         return self.buf.write(parent, child, data, offset)
 
+    @metrics.timed('fs.mkdir')
     def mkdir (self, path, mode):
         """ Create a new directory (an album) """
-        print '*** mkdir', path, oct(mode)
+        log.debug('mkdir %s %o', path, mode)
         parent, child = split_path(path)
 
         # Can't have directories (albums) at second level
         if parent != None:
             return - errno.ENOSYS
         else:
-            self.imgur.create_album(child)
-
+            try:
+                self.imgur.create_album(child)
+            except Offline:
+                # Created on imgur by Journal.replay
+                self.journal.add_album(child)
+            self.imgur.index.forget_missing(path)
+
+    @metrics.timed('fs.rmdir')
     def rmdir (self, path):
         """ Remove a directory (album) """
-        print '*** rmdir', path
+        log.debug('rmdir %s', path)
         parent, child = split_path(path)
         if len(self.imgur.image_list(child)):
             return -errno.ENOTEMPTY
         return -errno.ENOSYS
 
+    @metrics.timed('fs.rename')
     def rename (self, old_path, new_path):
         """ Handle:
             * Move an image out of an album
@@ -224,24 +498,63 @@ class ImgurFS (fuse.Fuse):
             * Rename an album
             * Move an image out of one album into another album
             """
-        print '*** rename', old_path, new_path
+        log.debug('rename %s %s', old_path, new_path)
 
         old_parent, old_child = split_path(old_path)
         new_parent, new_child = split_path(new_path)
 
         return -errno.ENOSYS
 
+    @metrics.timed('fs.statfs')
     def statfs (self):
         """ Returns API limit remaining as statfs """
-        print '*** statfs'
+        log.debug('statfs')
         st = fuse.StatVfs()
         st.f_bsize = 1
         st.f_frsize = 1
-        st.f_blocks = self.imgur.ratelimit['limit']
-        st.f_bfree = self.imgur.ratelimit['remaining']
+        # Unknown until the first api request
+        st.f_blocks = self.imgur.ratelimit['limit'] or 0
+        st.f_bfree = self.imgur.ratelimit['remaining'] or 0
         return st
 
+    @metrics.timed('fs.unlink')
     def unlink (self, path):
         """ Remove an image """
-        print '*** unlink', path
+        log.debug('unlink %s', path)
         return -errno.ENOSYS
+
+    def fsinit (self):
+        """ Called once fuse runs in the background. The mount works
+            from the index snapshot right away, signing in, the first
+            listings and sending what was journaled offline before the
+            last unmount go on in a thread """
+        self.mark('mounted')
+        thread = threading.Thread(target = self.warm_up)
+        thread.daemon = True
+        thread.start()
+
+    def warm_up (self):
+        """ Sign in and list / unless the snapshot has it, then replay
+            the journal """
+        try:
+            self.imgur.sign_in()
+            self.mark('signed_in')
+            self.imgur.image_list(None)
+            self.imgur.album_list()
+            self.mark('listed')
+        except Exception, e:
+            log.warning('Signing in or listing / at startup failed: %s', e)
+        if self.journal.entries:
+            self.journal.replay(self.imgur)
+
+    def mark (self, event):
+        """ Record how long after start event happened """
+        self.startup[event] = time.time() - self.started
+        log.info('%s %.3fs after start', event, self.startup[event])
+
+    def fsdestroy (self):
+        """ Called on unmount, finishes the uploads, journaling those
+            that take too long, then sends album adds that are still queued """
+        log.debug('fsdestroy')
+        self.uploads.drain(self.unmount_wait)
+        self.imgur.batcher.flush()
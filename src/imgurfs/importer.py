@@ -0,0 +1,260 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#=======================================================================
+#  imgurfs - Virtual file system for Imgur
+#  importer.py - Bulk import of local directories
+#  Copyright (c) 2012 Gaganpreet  <gaganpreet.arora@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import os
+import sys
+import time
+import getpass
+import hashlib
+import logging
+import optparse
+import threading
+from multiprocessing.pool import ThreadPool
+from api import Imgur
+from buf import Buffer, FileReader
+from conn import ConnectionPool
+from index import MetadataIndex
+from upload import AlbumBatcher, upload_with_retries
+from sync import KeyedLock
+from metrics import setup_logging
+
+log = logging.getLogger('imgurfs.importer')
+
+# Extensions of files imgur takes
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.apng', '.tif', '.tiff',
+                    '.bmp', '.pdf', '.xcf')
+
+def file_sha1 (path):
+    """ Hex sha1 of the content of a file """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(64 * 1024)
+            if not data:
+                return sha1.hexdigest()
+            sha1.update(data)
+
+class Importer:
+    """ Uploads local images with a pool of workers
+
+        Content we uploaded before is recognized by its sha1 (kept in the
+        index), so an interrupted import can simply be run again: known
+        images are skipped, or added to the album if they are elsewhere.
+        Album adds go through the AlbumBatcher of imgur
+    """
+
+    def __init__ (self, imgur, workers = 4, retries = 3, backoff = 2):
+        self.imgur = imgur
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        # Per sha1, so the same content in two files is uploaded once
+        self.digest_locks = KeyedLock()
+        self.stats = dict(files = 0, done = 0, uploaded = 0, linked = 0,
+                          skipped = 0, failed = 0, bytes = 0)
+        # (path, error) of files we gave up on
+        self.failed = []
+        self.start = time.time()
+
+    def scan (self, root, album = None):
+        """ Images under root as (album, name, path)
+            Files in root go to album (None for no album), files in a
+            subdirectory into an album named after it, unless album is
+            given. Deeper directories go into the album of their top one
+        """
+        items = []
+        root = os.path.abspath(root)
+        for directory, dirs, files in os.walk(root):
+            dirs.sort()
+            relative = os.path.relpath(directory, root)
+            target = album
+            if target == None and relative != '.':
+                target = relative.split(os.sep)[0]
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                    items.append((target, name, os.path.join(directory, name)))
+        return items
+
+    def prepare (self, items):
+        """ Create missing albums and list the ones we import into """
+        albums = set(album for album, name, path in items)
+        existing = self.imgur.album_list()
+        for album in sorted(albums):
+            if album != None and album not in existing:
+                log.info('Creating album %s', album)
+                self.imgur.create_album(album)
+                existing = self.imgur.album_list()
+        # Skipping known images needs up to date listings, a stale one
+        # would be served as is and refreshed in the background
+        imgur = self.imgur
+        for album in albums:
+            if imgur.index.images(album) == None or \
+               not imgur.refresher.is_fresh(album, imgur.index.listing_time(album)):
+                imgur.flights.do(album, imgur.refresh_images, album)
+
+    def count (self, result, size = 0):
+        with self.lock:
+            self.stats[result] += 1
+            self.stats['done'] += 1
+            self.stats['bytes'] += size
+
+    def import_file (self, item):
+        """ Upload one file unless its content is on imgur already """
+        album, name, path = item
+        try:
+            size = os.path.getsize(path)
+            if size > Buffer.max_image_size:
+                raise IOError('bigger than %d bytes' % Buffer.max_image_size)
+            sha1 = file_sha1(path)
+        except (IOError, OSError), e:
+            self.give_up(path, e)
+            return
+
+        with self.digest_locks(sha1):
+            imagehash = self.imgur.index.digest_hash(sha1)
+            if imagehash == None:
+                return self.upload(album, name, path, size, sha1)
+        listing = self.imgur.index.images(album) or {}
+        if album == None or imagehash in [r.hash for r in listing.itervalues()]:
+            return self.count('skipped')
+        self.imgur.batcher.add(album, imagehash)
+        self.count('linked')
+
+    def upload (self, album, name, path, size, sha1):
+        """ Upload a file, retrying failures with backoff """
+        def attempt ():
+            data = FileReader(path)
+            try:
+                return self.imgur.upload_image(album, name, data, sha1)
+            finally:
+                data.close()
+        record, error = upload_with_retries(attempt, self.retries, self.backoff)
+        if record:
+            return self.count('uploaded', size)
+        self.give_up(path, error)
+
+    def give_up (self, path, error):
+        log.error('Giving up importing %s: %s', path, error)
+        with self.lock:
+            self.failed.append((path, str(error)))
+        self.count('failed')
+
+    def run (self, items, progress = None):
+        """ Import items from scan(), calling progress() after each file
+            Returns the stats """
+        self.stats['files'] = len(items)
+        self.start = time.time()
+        pool = ThreadPool(self.workers)
+        try:
+            for result in pool.imap_unordered(self.import_file, items):
+                if progress != None:
+                    progress()
+        finally:
+            pool.close()
+            pool.join()
+        self.imgur.batcher.flush()
+        return self.stats
+
+    def progress_line (self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        s = self.stats
+        return '%d/%d files: %d uploaded, %d linked, %d skipped, %d failed, ' \
+               '%.1f MB, %.1f files/s, %.2f MB/s' % \
+               (s['done'], s['files'], s['uploaded'], s['linked'], s['skipped'],
+                s['failed'], s['bytes'] / 1048576.0, s['done'] / elapsed,
+                s['bytes'] / 1048576.0 / elapsed)
+
+def main ():
+    parser = optparse.OptionParser(usage = '%prog [options] DIRECTORY...',
+                                   description = 'Upload the images under '
+                                   'DIRECTORY to imgur. Images in subdirectories '
+                                   'go into albums named after them.')
+    parser.add_option('-u', '--username', help = 'imgur username or email')
+    parser.add_option('--password-file', metavar = 'PATH',
+                      help = 'file holding the imgur password')
+    parser.add_option('-a', '--album', metavar = 'NAME',
+                      help = 'put every image into album NAME')
+    parser.add_option('-w', '--workers', type = 'int', default = 4,
+                      help = 'images uploaded in parallel [default: %default]')
+    parser.add_option('--retries', type = 'int', default = 3,
+                      help = 'retries of a failed upload [default: %default]')
+    parser.add_option('--cache-dir', metavar = 'PATH',
+                      default = os.path.expanduser('~/.cache/imgurfs'),
+                      help = 'where the index is kept, shared with '
+                      'mount.imgurfs [default: %default]')
+    parser.add_option('--api-endpoint', metavar = 'URL',
+                      default = 'https://api.imgur.com/2/',
+                      help = 'imgur api to use [default: %default]')
+    parser.add_option('-q', '--quiet', action = 'store_true',
+                      help = 'only print the summary')
+    parser.add_option('--log-level', metavar = 'LEVEL',
+                      help = 'log debug, info, warning or error messages')
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('no directory to import')
+    if options.log_level:
+        setup_logging(options.log_level)
+
+    username = options.username or os.environ.get('IMGURFS_USERNAME') or \
+               raw_input('Imgur username/email: ')
+    password = os.environ.get('IMGURFS_PASSWORD')
+    if options.password_file:
+        with open(options.password_file) as f:
+            password = f.read().strip()
+    # The session mount.imgurfs saved works here too
+    http = ConnectionPool(max(options.workers, 4),
+                          cookie_file = os.path.join(options.cache_dir, 'session',
+                                                     username + '.cookies'))
+    index = MetadataIndex(os.path.join(options.cache_dir, 'metadata',
+                                       username + '.db'))
+    imgur = Imgur(username, password, index, http, options.api_endpoint)
+    if password == None and not imgur.session:
+        imgur.password = getpass.getpass('Password: ')
+    try:
+        imgur.sign_in()
+    except IOError, e:
+        sys.exit('Signing in failed: %s' % (e.strerror or e))
+    imgur.batcher = AlbumBatcher(imgur)
+    importer = Importer(imgur, options.workers, options.retries)
+
+    items = []
+    for root in args:
+        items.extend(importer.scan(root, options.album))
+    importer.prepare(items)
+
+    shown = [0]
+    def progress ():
+        if options.quiet or time.time() - shown[0] < 1:
+            return
+        shown[0] = time.time()
+        sys.stderr.write('\r' + importer.progress_line())
+        sys.stderr.flush()
+
+    importer.run(items, progress)
+    if not options.quiet:
+        sys.stderr.write('\r')
+    print importer.progress_line()
+    for path, error in importer.failed:
+        print 'Failed:', path, error
+    if importer.failed:
+        sys.exit(1)
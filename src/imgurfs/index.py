@@ -0,0 +1,320 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#=======================================================================
+#  imgurfs - Virtual file system for Imgur
+#  index.py - Persistent index of image and album metadata
+#  Copyright (c) 2012 Gaganpreet  <gaganpreet.arora@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+class Record(object):
+    """ Base for compact metadata records
+        Fields can also be read with record['field'] like the dicts
+        the api used to return. Only `fields` are stored in the index,
+        other slots are derived from them
+    """
+    __slots__ = ()
+    fields = ()
+
+    def __init__ (self, *values):
+        for field, value in zip(self.fields, values):
+            setattr(self, field, value)
+
+    def __getitem__ (self, field):
+        return getattr(self, field)
+
+    def values (self):
+        return tuple(getattr(self, field) for field in self.fields)
+
+class ImageRecord(Record):
+    """ Metadata of one image
+
+        mtime is the upload time as a unix timestamp, parsed once here
+        rather than on every getattr. stat is left for the filesystem to
+        keep its attributes for the image in
+    """
+    fields = ('hash', 'size', 'type', 'datetime', 'deletehash', 'link')
+    __slots__ = fields + ('mtime', 'stat')
+
+    def __init__ (self, *values):
+        Record.__init__(self, *values)
+        self.mtime = int(time.mktime(time.strptime(self.datetime,
+                                                   '%Y-%m-%d %H:%M:%S')))
+        self.stat = None
+
+class AlbumRecord(Record):
+    """ Metadata of one album """
+    fields = ('id', 'datetime')
+    __slots__ = fields
+
+class MetadataIndex:
+    """ Path to metadata map for the whole account
+
+        Everything is held in dictionaries for constant time lookups
+        and written through to an sqlite file, so a new mount starts
+        with the listings of the previous one
+    """
+
+    def __init__ (self, filename, missing_limit = 10000):
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread = False)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS images (hash TEXT PRIMARY KEY,
+                size INTEGER, type TEXT, datetime TEXT, deletehash TEXT,
+                link TEXT);
+            CREATE TABLE IF NOT EXISTS entries (album TEXT, name TEXT,
+                hash TEXT, PRIMARY KEY (album, name));
+            CREATE TABLE IF NOT EXISTS albums (name TEXT PRIMARY KEY,
+                id TEXT, datetime TEXT);
+            CREATE TABLE IF NOT EXISTS listings (album TEXT PRIMARY KEY,
+                time REAL);
+            CREATE TABLE IF NOT EXISTS contents (hash TEXT PRIMARY KEY,
+                sha1 TEXT);
+        ''')
+
+        # Album name -> {image name -> ImageRecord}
+        # None album holds unorganized images (/ directory)
+        self.listings = {}
+        self.times = {}
+        # Album name -> AlbumRecord
+        self.albums = {}
+        # Every path we know of: /album/name or /name -> ImageRecord,
+        # /album -> AlbumRecord. An image in / wins over an album with
+        # the same name
+        self.paths = {}
+        # Image hash -> ImageRecord
+        self.hashes = {}
+        # Paths that were looked up and not found -> when that expires,
+        # oldest first. At most missing_limit of them are kept
+        self.missing = OrderedDict()
+        self.missing_limit = missing_limit
+        # Image hash -> sha1 of its content, for images we uploaded or
+        # downloaded. Several images can have the same content
+        self.contents = {}
+        # sha1 -> an image hash with that content
+        self.digests = {}
+        self.load()
+
+    def load (self):
+        """ Read the snapshot left by the last mount """
+        for row in self.db.execute('SELECT * FROM images'):
+            self.hashes[row[0]] = ImageRecord(*row)
+        for album, name, imagehash in self.db.execute('SELECT * FROM entries'):
+            album = album and str(album) or None
+            if imagehash in self.hashes:
+                self.listings.setdefault(album, {})[str(name)] = self.hashes[imagehash]
+        for name, id, datetime in self.db.execute('SELECT * FROM albums'):
+            self.albums[str(name)] = AlbumRecord(id, datetime)
+        for imagehash, sha1 in self.db.execute('SELECT * FROM contents'):
+            self.contents[str(imagehash)] = str(sha1)
+            self.digests[str(sha1)] = str(imagehash)
+        for album, listed in self.db.execute('SELECT * FROM listings'):
+            # '' is the unorganized images, '/' the album list itself
+            album = album and str(album) or None
+            self.times[album] = listed
+            if album != '/':
+                self.listings.setdefault(album, {})
+
+        for name, record in self.albums.iteritems():
+            self.paths['/' + name] = record
+        for album, images in self.listings.iteritems():
+            for name in images:
+                self.paths[self.path(album, name)] = images[name]
+
+    def path (self, album, name):
+        """ Absolute path of an image """
+        if album == None:
+            return '/' + name
+        return '/' + album + '/' + name
+
+    def images (self, album):
+        """ Images of album as {name: ImageRecord}, None if never listed """
+        if album not in self.times:
+            return None
+        return self.listings.get(album, {})
+
+    def listing_time (self, album):
+        """ When album was last listed, 0 if never """
+        return self.times.get(album, 0)
+
+    def set_images (self, album, images, listed):
+        """ Replace the listing of album with images ({name: ImageRecord}),
+            listed at time `listed` """
+        with self.lock:
+            # Add the new paths before dropping old ones, readers
+            # don't take the lock and shouldn't see paths vanish
+            for name, record in images.iteritems():
+                path = self.path(album, name)
+                self.paths[path] = record
+                self.missing.pop(path, None)
+                self.hashes[record.hash] = record
+            for name in self.listings.get(album, {}):
+                if name not in images:
+                    self.paths.pop(self.path(album, name), None)
+                    # Uncover an album the image was hiding
+                    if album == None and name in self.albums:
+                        self.paths['/' + name] = self.albums[name]
+            self.listings[album] = images
+            self.times[album] = listed
+
+            key = album or ''
+            with self.db:
+                self.db.execute('DELETE FROM entries WHERE album = ?', (key,))
+                self.db.executemany('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)',
+                                    [r.values() for r in images.itervalues()])
+                self.db.executemany('INSERT INTO entries VALUES (?, ?, ?)',
+                                    [(key, name, r.hash) for name, r in images.iteritems()])
+                self.db.execute('INSERT OR REPLACE INTO listings VALUES (?, ?)', (key, listed))
+                # Images we know the content of stay, for linking copies
+                self.db.execute('DELETE FROM images WHERE hash NOT IN (SELECT hash FROM entries) '
+                                'AND hash NOT IN (SELECT hash FROM contents)')
+
+    def add_image (self, album, name, record):
+        """ Add an image we uploaded to the listing of album, if it
+            was listed before. Only the one image is written out """
+        if album not in self.times:
+            return
+        path = self.path(album, name)
+        with self.lock:
+            # Copied, readers may be iterating over the old listing
+            images = dict(self.listings.get(album, {}))
+            images[name] = record
+            self.listings[album] = images
+            self.paths[path] = record
+            self.missing.pop(path, None)
+            self.hashes[record.hash] = record
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)',
+                                record.values())
+                self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                                (album or '', name, record.hash))
+
+    def expire (self, album):
+        """ Make the next image_list of album refresh it, after we
+            changed it ourselves """
+        with self.lock:
+            if album in self.times:
+                self.times[album] = 0
+                with self.db:
+                    self.db.execute('UPDATE listings SET time = 0 WHERE album = ?',
+                                    (album or '',))
+
+    def album_list (self):
+        """ Albums as {name: AlbumRecord} """
+        return self.albums
+
+    def albums_time (self):
+        """ When the album list was last fetched, 0 if never """
+        return self.times.get('/', 0)
+
+    def set_albums (self, albums, listed):
+        """ Replace the album list with albums ({name: AlbumRecord}),
+            listed at time `listed` """
+        with self.lock:
+            for name, record in albums.iteritems():
+                path = '/' + name
+                self.missing.pop(path, None)
+                if not isinstance(self.paths.get(path), ImageRecord):
+                    self.paths[path] = record
+            for name in self.albums:
+                if name not in albums and \
+                   isinstance(self.paths.get('/' + name), AlbumRecord):
+                    del self.paths['/' + name]
+            self.albums = albums
+            self.times['/'] = listed
+            with self.db:
+                self.db.execute('DELETE FROM albums')
+                self.db.executemany('INSERT INTO albums VALUES (?, ?, ?)',
+                                    [(name,) + r.values() for name, r in albums.iteritems()])
+                self.db.execute('INSERT OR REPLACE INTO listings VALUES (?, ?)', ('/', listed))
+
+    def lookup (self, path):
+        """ Return the ImageRecord or AlbumRecord for path, None if unknown """
+        return self.paths.get(path)
+
+    def is_missing (self, path):
+        """ Whether path was recently looked up and not found """
+        with self.lock:
+            expires = self.missing.get(path)
+            if expires == None:
+                return False
+            if expires < time.time():
+                self.missing.pop(path, None)
+                return False
+            return True
+
+    def add_missing (self, path, ttl):
+        """ Remember for ttl seconds that path doesn't exist
+            Expired entries are swept from the front, and the oldest
+            dropped once there are missing_limit of them
+        """
+        now = time.time()
+        with self.lock:
+            self.missing.pop(path, None)
+            self.missing[path] = now + ttl
+            while self.missing:
+                oldest, expires = next(self.missing.iteritems())
+                if expires >= now and len(self.missing) <= self.missing_limit:
+                    break
+                self.missing.popitem(last = False)
+
+    def forget_missing (self, path):
+        """ Drop negative entries for path and anything under it,
+            after we created it """
+        prefix = path + '/'
+        with self.lock:
+            self.missing.pop(path, None)
+            for missing in [m for m in self.missing if m.startswith(prefix)]:
+                self.missing.pop(missing, None)
+
+    def digest_hash (self, sha1):
+        """ Hash of an image with content sha1, None if we know of none """
+        return self.digests.get(sha1)
+
+    def content_digest (self, imagehash):
+        """ sha1 of the content of an image, None if we never had it """
+        return self.contents.get(imagehash)
+
+    def add_digest (self, sha1, record):
+        """ Remember that the image of record has content sha1
+            The record is kept too, so by_hash() finds it even if it is
+            in no listing we loaded
+        """
+        with self.lock:
+            if self.contents.get(record.hash) == sha1:
+                return
+            self.contents[record.hash] = sha1
+            self.digests[sha1] = record.hash
+            self.hashes[record.hash] = record
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)',
+                                record.values())
+                self.db.execute('INSERT OR REPLACE INTO contents VALUES (?, ?)',
+                                (record.hash, sha1))
+
+    def by_hash (self, imagehash):
+        """ Return the ImageRecord of an image hash, None if unknown """
+        return self.hashes.get(imagehash)
@@ -0,0 +1,165 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#=======================================================================
+#  imgurfs - Virtual file system for Imgur
+#  metrics.py - Counters, latency histograms and logging setup
+#  Copyright (c) 2012 Gaganpreet  <gaganpreet.arora@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import time
+import bisect
+import logging
+import functools
+import threading
+
+# Nothing is logged unless setup_logging() is called
+logging.getLogger('imgurfs').addHandler(logging.NullHandler())
+
+class Histogram:
+    """ Latencies counted in exponential buckets, cheap enough to
+        update on every call. Percentiles are the upper bound of the
+        bucket they fall in
+    """
+    # Bucket upper bounds in seconds, 100us doubling up to about 100s
+    bounds = [0.0001 * 2 ** i for i in xrange(21)]
+
+    def __init__ (self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe (self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile (self, fraction):
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= self.count * fraction and seen:
+                return i < len(self.bounds) and self.bounds[i] or self.max
+        return 0
+
+    def as_dict (self):
+        """ Summary in milliseconds """
+        return dict(count = self.count,
+                    mean_ms = self.count and self.total / self.count * 1000 or 0,
+                    p50_ms = self.percentile(0.5) * 1000,
+                    p90_ms = self.percentile(0.9) * 1000,
+                    p99_ms = self.percentile(0.99) * 1000,
+                    max_ms = self.max * 1000)
+
+class Timer:
+    """ with metrics.timer(name): records how long the block took """
+
+    def __init__ (self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__ (self):
+        self.start = time.time()
+        return self
+
+    def __exit__ (self, type, value, traceback):
+        self.metrics.observe(self.name, time.time() - self.start)
+        if type != None:
+            self.metrics.incr(self.name + '.errors')
+
+class Metrics:
+    """ Named counters, latency histograms and gauges
+
+        Gauges are functions called when a snapshot is taken, for values
+        other objects already keep (queue lengths, the rate limit left)
+    """
+
+    def __init__ (self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def incr (self, name, count = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def observe (self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram == None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def timer (self, name):
+        return Timer(self, name)
+
+    def timed (self, name):
+        """ Decorator recording the latency of each call under name,
+            calls that raise or return a negative errno count as errors """
+        def decorator (function):
+            @functools.wraps(function)
+            def wrapper (*args, **kw):
+                start = time.time()
+                try:
+                    result = function(*args, **kw)
+                except:
+                    self.incr(name + '.errors')
+                    raise
+                finally:
+                    self.observe(name, time.time() - start)
+                if isinstance(result, int) and result < 0:
+                    self.incr(name + '.errors')
+                return result
+            return wrapper
+        return decorator
+
+    def gauge (self, name, function):
+        """ Report function() as name in snapshots """
+        self.gauges[name] = function
+
+    def snapshot (self):
+        """ Everything as a dict that can be dumped as JSON """
+        with self.lock:
+            counters = dict(self.counters)
+            latency = dict((name, h.as_dict()) for name, h in self.histograms.iteritems())
+        gauges = {}
+        for name, function in self.gauges.items():
+            try:
+                gauges[name] = function()
+            except Exception, e:
+                gauges[name] = 'error: %s' % e
+        return dict(uptime = time.time() - self.started, counters = counters,
+                    latency = latency, gauges = gauges)
+
+# Shared by all modules
+metrics = Metrics()
+
+def setup_logging (level, filename = None):
+    """ Log imgurfs messages of level (a name like 'debug') and up to
+        filename, or stderr """
+    if filename:
+        handler = logging.FileHandler(filename)
+    else:
+        handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(threadName)s '
+                                           '%(name)s %(levelname)s %(message)s'))
+    logger = logging.getLogger('imgurfs')
+    logger.addHandler(handler)
+    logger.setLevel(getattr(logging, level.upper()))
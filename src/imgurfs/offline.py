@@ -0,0 +1,214 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#=======================================================================
+#  imgurfs - Virtual file system for Imgur
+#  offline.py - Working from local state while imgur is unreachable
+#  Copyright (c) 2012 Gaganpreet  <gaganpreet.arora@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import os
+import json
+import time
+import uuid
+import errno
+import shutil
+import logging
+import tempfile
+import threading
+from buf import FileReader
+
+log = logging.getLogger('imgurfs.offline')
+
+class Offline(IOError):
+    """ Imgur can't be reached, fuse turns it into ENETDOWN """
+
+    def __init__ (self):
+        IOError.__init__(self, errno.ENETDOWN, 'imgur is unreachable, working offline')
+
+class Connectivity:
+    """ Decides whether we are online, from how requests went
+
+        After `threshold` requests in a row failed with a network error,
+        a timeout or a 5xx status, we go offline: requests fail with
+        Offline right away instead of waiting on timeouts, and imgur is
+        probed every `interval` seconds. Once it answers, we are back
+        online and the on_online callbacks run (in the probe thread)
+    """
+
+    def __init__ (self, http, probe_url, threshold = 3, interval = 30):
+        self.http = http
+        self.probe_url = probe_url
+        self.threshold = threshold
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.offline = False
+        self.on_online = []
+        self.stats = dict(offline = False, since = None, switches = 0, probes = 0)
+
+    def check (self):
+        """ Raise Offline instead of letting a request wait on a timeout """
+        if self.offline:
+            raise Offline()
+
+    def success (self):
+        self.failures = 0
+
+    def failure (self):
+        with self.lock:
+            self.failures += 1
+            if self.offline or self.failures < self.threshold:
+                return
+            self.offline = True
+            self.stats.update(offline = True, since = time.time())
+            self.stats['switches'] += 1
+        log.warning('%d requests failed in a row, working offline', self.failures)
+        thread = threading.Thread(target = self.probe)
+        thread.daemon = True
+        thread.start()
+
+    def probe (self):
+        """ Wait for imgur to answer again, any status below 500 will do """
+        while True:
+            time.sleep(self.interval)
+            self.stats['probes'] += 1
+            try:
+                if self.http.send(self.probe_url, None, {}, None).code < 500:
+                    break
+            except Exception, e:
+                log.debug('Probe failed: %s', e)
+
+        with self.lock:
+            self.offline = False
+            self.failures = 0
+            self.stats.update(offline = False, since = time.time())
+            self.stats['switches'] += 1
+        log.warning('Imgur is reachable again, working online')
+        for callback in self.on_online:
+            try:
+                callback()
+            except Exception, e:
+                log.error('Going online failed: %s', e)
+
+class Journal:
+    """ Albums created and images written while offline
+
+        Kept in directory until they are replayed, so they survive an
+        unmount. Entries are replayed in order, so an album made
+        offline exists before the images written into it are added
+    """
+
+    def __init__ (self, directory):
+        self.directory = directory
+        self.filename = os.path.join(directory, 'journal.json')
+        # Serializes replays, entries are replayed one at a time
+        self.replay_lock = threading.Lock()
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.entries = []
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                self.entries = json.load(f)
+        for entry in self.entries:
+            # Fuse doesn't like unicode
+            for field in ('album', 'name'):
+                if entry.get(field) != None:
+                    entry[field] = str(entry[field])
+
+    def save (self):
+        """ Must be called with lock held """
+        fd, tmp = tempfile.mkstemp(prefix = '.', dir = self.directory)
+        f = os.fdopen(fd, 'w')
+        try:
+            json.dump(self.entries, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.filename)
+
+    def add_album (self, album):
+        with self.lock:
+            self.entries.append(dict(op = 'mkdir', album = album))
+            self.save()
+
+    def add_upload (self, album, name, data):
+        """ Copy data (a file-like object) into the journal """
+        filename = uuid.uuid4().hex
+        with open(os.path.join(self.directory, filename), 'wb') as f:
+            shutil.copyfileobj(data, f)
+            size = f.tell()
+        with self.lock:
+            # A newer write of the same file replaces the older one
+            for entry in self.entries:
+                if entry['op'] == 'upload' and entry['album'] == album and \
+                   entry['name'] == name:
+                    self.remove(entry)
+                    break
+            self.entries.append(dict(op = 'upload', album = album, name = name,
+                                     file = filename, size = size))
+            self.save()
+
+    def remove (self, entry):
+        """ Must be called with lock held """
+        if entry not in self.entries:
+            # Replaced by a newer write while it was replayed
+            return
+        self.entries.remove(entry)
+        if entry['op'] == 'upload':
+            try:
+                os.unlink(os.path.join(self.directory, entry['file']))
+            except OSError:
+                pass
+
+    def albums (self):
+        """ Names of albums created offline """
+        return [e['album'] for e in self.entries if e['op'] == 'mkdir']
+
+    def uploads (self, album):
+        """ {name: size} of images written to album offline """
+        return dict((e['name'], e['size']) for e in self.entries
+                    if e['op'] == 'upload' and e['album'] == album)
+
+    def replay (self, imgur):
+        """ Send what was journaled to imgur, oldest first
+            Stops at the first failure, the rest stays for the next try.
+            Uploads imgur rejects are dropped, they would never go through
+        """
+        with self.replay_lock:
+            while self.entries:
+                entry = self.entries[0]
+                try:
+                    if entry['op'] == 'mkdir':
+                        if entry['album'] not in imgur.album_list():
+                            imgur.create_album(entry['album'])
+                    else:
+                        data = FileReader(os.path.join(self.directory, entry['file']))
+                        try:
+                            if not imgur.upload_image(entry['album'], entry['name'], data):
+                                log.error('Imgur rejected %s, dropping it', entry['name'])
+                        finally:
+                            data.close()
+                except Exception, e:
+                    log.warning('Replaying %s of %s stopped: %s', entry['op'],
+                                entry.get('name', entry['album']), e)
+                    return False
+                log.info('Replayed %s of %s', entry['op'],
+                         entry.get('name', entry['album']))
+                with self.lock:
+                    self.remove(entry)
+                    self.save()
+            return True
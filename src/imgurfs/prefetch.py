@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#=======================================================================
+#  imgurfs - Virtual file system for Imgur
+#  prefetch.py - Background read-ahead of album contents
+#  Copyright (c) 2012 Gaganpreet  <gaganpreet.arora@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import time
+import bisect
+import logging
+import threading
+from scheduler import PREFETCH
+from offline import Offline
+
+log = logging.getLogger('imgurfs.prefetch')
+
+class Prefetcher:
+    """ Downloads the next images of an album into the read cache
+
+        After a readdir the first `count` images (by name) are fetched,
+        after sequential opens the `count` images following the opened
+        one. A newer request replaces what is still queued. Downloads
+        are paced to `rate` bytes per second (0 for no limit) and stop
+        while the request scheduler keeps the rate limit left for more
+        important requests
+    """
+
+    def __init__ (self, buf, imgur, count, rate):
+        self.buf = buf
+        self.imgur = imgur
+        self.count = count
+        self.rate = rate
+        self.cond = threading.Condition()
+        self.queue = []
+        # album -> name of the last opened image
+        self.last_open = {}
+        # album -> (listing, its names sorted)
+        self.names = {}
+        self.thread = None
+        self.stats = dict(fetched = 0, bytes = 0, skipped = 0)
+
+    def sorted_names (self, album, images):
+        """ Names of a listing in order, kept until the listing changes """
+        cached = self.names.get(album)
+        if cached == None or cached[0] is not images:
+            cached = self.names[album] = (images, sorted(images))
+        return cached[1]
+
+    def after_readdir (self, album, images):
+        """ images is the {name: ImageRecord} listing of album """
+        if not self.count:
+            return
+        names = self.sorted_names(album, images)[:self.count]
+        self.schedule([images[name] for name in names])
+
+    def after_open (self, album, name, images):
+        """ Prefetch what follows name if the last open in album was
+            the image right before it """
+        if not self.count or name not in images:
+            return
+        names = self.sorted_names(album, images)
+        i = bisect.bisect_left(names, name)
+        previous = self.last_open.get(album)
+        self.last_open[album] = name
+        if i > 0 and names[i - 1] == previous:
+            self.schedule([images[n] for n in names[i + 1:i + 1 + self.count]])
+
+    def schedule (self, images):
+        images = [image for image in images if not self.buf.is_cached(image)]
+        with self.cond:
+            self.queue = images
+            if self.thread == None:
+                self.thread = threading.Thread(target = self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+
+    def run (self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                image = self.queue.pop(0)
+
+            if not self.imgur.scheduler.allows(PREFETCH):
+                self.stats['skipped'] += 1
+                continue
+            start = time.time()
+            try:
+                size = self.buf.fetch(image)
+            except Offline:
+                self.stats['skipped'] += 1
+                continue
+            except Exception, e:
+                log.warning('Prefetching %s failed: %s', image['link'], e)
+                continue
+            self.stats['fetched'] += 1
+            self.stats['bytes'] += size
+            # Keep to the bandwidth budget
+            if self.rate <= 0:
+                continue
+            delay = float(size) / self.rate - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#=======================================================================
+#  imgurfs - Virtual file system for Imgur
+#  refresh.py - Background refresh of expired listings
+#  Copyright (c) 2012 Gaganpreet  <gaganpreet.arora@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import time
+import logging
+import threading
+from scheduler import RateLimited, REFRESH
+from offline import Offline
+
+log = logging.getLogger('imgurfs.refresh')
+
+class Refresher:
+    """ Stale-while-revalidate for listings
+
+        An expired listing is still served, and refreshed here in the
+        background. Each listing has its own refresh interval between
+        minimum and maximum seconds: halved when a refresh finds changes,
+        doubled when it doesn't. Fixed intervals can be given per listing
+        in overrides
+
+        Listings are keyed like the index does: album name, None for the
+        unorganized images and '/' for the album list
+    """
+
+    def __init__ (self, imgur, minimum, maximum, overrides = {}):
+        self.imgur = imgur
+        self.minimum = minimum
+        self.maximum = maximum
+        self.overrides = overrides
+        self.intervals = {}
+        self.cond = threading.Condition()
+        self.queue = []
+        self.thread = None
+
+    def interval (self, key):
+        """ Seconds a listing stays fresh """
+        if key in self.overrides:
+            return self.overrides[key]
+        return self.intervals.get(key, self.minimum)
+
+    def is_fresh (self, key, listing_time):
+        return time.time() - listing_time < self.interval(key)
+
+    def changed (self, key, changed):
+        """ Adapt the interval of a listing after it was refreshed """
+        interval = self.intervals.get(key, self.minimum)
+        if changed:
+            interval = max(self.minimum, interval / 2)
+        else:
+            interval = min(self.maximum, interval * 2)
+        self.intervals[key] = interval
+
+    def schedule (self, key):
+        """ Queue a listing for refresh, if it isn't already """
+        with self.cond:
+            if key in self.queue:
+                return
+            self.queue.append(key)
+            if self.thread == None:
+                self.thread = threading.Thread(target = self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+
+    def run (self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                key = self.queue[0]
+
+            # Interactive misses on the same listing join this refresh
+            try:
+                if key == '/':
+                    self.imgur.flights.do(key, self.imgur.refresh_albums, REFRESH)
+                else:
+                    self.imgur.flights.do(key, self.imgur.refresh_images, key, REFRESH)
+            except (RateLimited, Offline):
+                # Keep serving the stale listing, it's retried once
+                # someone looks at it again
+                pass
+            except Exception, e:
+                log.warning('Background refresh of %s failed: %s', key, e)
+
+            with self.cond:
+                self.queue.remove(key)
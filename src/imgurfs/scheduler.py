@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#=======================================================================
+#  imgurfs - Virtual file system for Imgur
+#  scheduler.py - Rate limit aware pacing of api requests
+#  Copyright (c) 2012 Gaganpreet  <gaganpreet.arora@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import time
+import errno
+import threading
+
+# Priority classes, most important first
+INTERACTIVE, REFRESH, PREFETCH, UPLOAD = range(4)
+PRIORITY_NAMES = ['interactive', 'refresh', 'prefetch', 'upload']
+
+class RateLimited(IOError):
+    """ The rate limit left is reserved for more important requests
+        Fuse turns it into EAGAIN if nobody serves stale data instead
+    """
+
+    def __init__ (self, priority):
+        IOError.__init__(self, errno.EAGAIN, 'Rate limit reserved, refusing %s request'
+                         % PRIORITY_NAMES[priority])
+
+class RequestScheduler:
+    """ Token bucket in front of api requests
+
+        Requests go through unpaced while more than `pacing` of the limit
+        is left. Below that, the refill rate spreads the requests imgur
+        says are left over what is left of the rate limit window, so the
+        budget lasts until the reset. When tokens run short, waiting
+        requests are served in priority order. Every class except
+        interactive lookups has a reserve: once less than that fraction of
+        the limit is left its requests fail with RateLimited, so callers
+        can fall back to stale cache
+    """
+
+    def __init__ (self, window = 3600, burst = 20, pacing = 0.3,
+                  reserves = {INTERACTIVE: 0, REFRESH: 0.2, PREFETCH: 0.3, UPLOAD: 0.05}):
+        self.window = window
+        self.burst = burst
+        self.pacing = pacing
+        self.reserves = reserves
+        self.cond = threading.Condition()
+        self.tokens = float(burst)
+        # Unlimited until the budget left runs low
+        self.rate = None
+        self.last = time.time()
+        self.remaining = None
+        self.limit = None
+        self.reset = None
+        # Requests waiting for a token, per priority class
+        self.waiting = [0] * len(PRIORITY_NAMES)
+        self.stats = dict(granted = [0] * len(PRIORITY_NAMES),
+                          refused = [0] * len(PRIORITY_NAMES))
+
+    def update (self, remaining, limit, reset = None):
+        """ Take in the rate limit reported by a response, reset is when
+            the window ends (unix time) if imgur says so """
+        with self.cond:
+            now = time.time()
+            if reset == None:
+                if self.reset == None or self.reset <= now:
+                    self.reset = now + self.window
+            else:
+                self.reset = reset
+            self.remaining = remaining
+            self.limit = limit
+            if remaining > limit * self.pacing:
+                self.rate = None
+            else:
+                self.rate = max(remaining, 0) / max(self.reset - now, 1.0)
+            self.cond.notify_all()
+
+    def restore (self):
+        """ Once the window imgur reported is over the whole limit is
+            back, even if no response told us so yet. Must be called
+            with cond held """
+        now = time.time()
+        if self.reset != None and self.reset <= now and self.limit != None:
+            self.remaining = self.limit
+            self.rate = None
+            self.reset = now + self.window
+
+    def allows (self, priority):
+        """ Whether the budget left isn't reserved for higher priorities """
+        with self.cond:
+            self.restore()
+            if self.remaining == None:
+                return True
+            if self.remaining <= 0:
+                return False
+            return self.remaining > self.limit * self.reserves[priority]
+
+    def refill (self):
+        self.restore()
+        now = time.time()
+        if self.rate == None:
+            self.tokens = float(self.burst)
+        else:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire (self, priority = INTERACTIVE):
+        """ Wait for a token, raises RateLimited if priority may not use
+            the budget that is left """
+        with self.cond:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    if not self.allows(priority):
+                        self.stats['refused'][priority] += 1
+                        raise RateLimited(priority)
+                    self.refill()
+                    ahead = sum(self.waiting[:priority])
+                    if self.tokens >= 1 and not ahead:
+                        self.tokens -= 1
+                        self.stats['granted'][priority] += 1
+                        return
+                    # Sleep until the next token, or until woken by a
+                    # release of a higher priority or a rate limit update
+                    wait = self.rate and (1 - self.tokens) / self.rate or 1
+                    self.cond.wait(min(max(wait, 0.01), 1))
+            finally:
+                self.waiting[priority] -= 1
+                self.cond.notify_all()
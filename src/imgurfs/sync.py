@@ -0,0 +1,106 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#=======================================================================
+#  imgurfs - Virtual file system for Imgur
+#  sync.py - Locking helpers for the multithreaded filesystem
+#  Copyright (c) 2012 Gaganpreet  <gaganpreet.arora@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import sys
+import threading
+
+class KeyedLock:
+    """ A lock per key, so work on one key doesn't block the others
+
+        Usage: with locks(key): ...
+        Locks are dropped once nobody holds or waits for them
+    """
+
+    def __init__ (self):
+        self.lock = threading.Lock()
+        # key -> [lock, number of holders and waiters]
+        self.locks = {}
+
+    def __call__ (self, key):
+        return KeyedLockContext(self, key)
+
+    def acquire (self, key):
+        with self.lock:
+            entry = self.locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+
+    def release (self, key):
+        with self.lock:
+            entry = self.locks[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+        entry[0].release()
+
+class KeyedLockContext:
+    def __init__ (self, locks, key):
+        self.locks = locks
+        self.key = key
+
+    def __enter__ (self):
+        self.locks.acquire(self.key)
+
+    def __exit__ (self, *exc):
+        self.locks.release(self.key)
+
+class Call:
+    """ A call in progress, shared by everyone who asked for it """
+    def __init__ (self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """ Deduplicates concurrent calls for the same key
+
+        The first caller runs the function, callers that arrive while it
+        runs wait and get the same result (or exception)
+    """
+
+    def __init__ (self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do (self, key, function, *args, **kw):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call == None
+            if leader:
+                call = self.calls[key] = Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result
+
+        try:
+            call.result = function(*args, **kw)
+        except:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
@@ -0,0 +1,388 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#=======================================================================
+#  imgurfs - Virtual file system for Imgur
+#  upload.py - Background upload queue
+#  Copyright (c) 2012 Gaganpreet  <gaganpreet.arora@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import time
+import Queue
+import logging
+import threading
+from collections import deque
+from buf import WriteBufferReader
+from offline import Offline
+from sync import KeyedLock
+
+log = logging.getLogger('imgurfs.upload')
+
+def upload_with_retries (attempt, retries, backoff, stop = (), failed = None):
+    """ Call attempt() until it returns an ImageRecord, retrying up to
+        retries times with exponential backoff. attempt returns False
+        when imgur rejected the image. Exceptions in stop are raised
+        right away, failed(error) is called after every failure
+        Returns the record, or None and the last error
+    """
+    error = None
+    for n in xrange(retries + 1):
+        if n:
+            time.sleep(backoff ** n)
+        try:
+            record = attempt()
+            if record:
+                return record, None
+            error = 'upload rejected'
+        except stop:
+            raise
+        except Exception, e:
+            error = e
+        if failed != None:
+            failed(error)
+    return None, error
+
+class Upload:
+    """ Status of one queued image, and the WriteBuffer it uploads """
+
+    def __init__ (self, album, name, buffer):
+        self.album = album
+        self.name = name
+        self.buffer = buffer
+        # pending, uploading, done, journaled, replaced or failed
+        self.state = 'pending'
+        self.attempts = 0
+        self.error = None
+        self.time = time.time()
+
+    def as_dict (self):
+        return dict(album = self.album, name = self.name, state = self.state,
+                    attempts = self.attempts, error = self.error,
+                    time = self.time)
+
+class UploadQueue:
+    """ Uploads closed files in the background
+
+        release() only queues the write buffer of the file, a pool of
+        workers uploads it, retrying with exponential backoff. The buffer
+        is kept until the upload is over, so the file stays visible
+        through Buffer.buffered_write_list meanwhile. A file rewritten
+        in the meantime gets a new buffer and is queued again. While offline, files go to
+        the journal instead, to be uploaded once imgur is back, and so
+        do files that ran out of retries
+
+        Files are hashed first: content we already have on imgur is
+        put into the album instead of uploaded again
+    """
+
+    def __init__ (self, imgur, buf, workers = 2, retries = 3, backoff = 2,
+                  journal = None, history = 100):
+        self.imgur = imgur
+        self.buf = buf
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.journal = journal
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        # (album, name) -> Upload that is queued, uploading or failed
+        self.uploads = {}
+        # The last `history` uploads that finished otherwise, for status
+        self.finished = deque(maxlen = history)
+        # Per sha1, so copies of one file written together are
+        # uploaded once and linked after that
+        self.digest_locks = KeyedLock()
+        # Workers are started on first use, after fuse has forked
+        self.threads = []
+
+    def put (self, album, name, buffer):
+        """ Queue the WriteBuffer of a closed file for upload
+            An older version of the file that didn't start uploading yet
+            is skipped
+        """
+        upload = Upload(album, name, buffer)
+        with self.lock:
+            old = self.uploads.get((album, name))
+            if old != None and old.state == 'pending':
+                old.state = 'replaced'
+            elif old != None and old.state == 'failed':
+                # Kept since it failed, the new write takes its place
+                self.buf.close_write(old.buffer)
+            self.uploads[(album, name)] = upload
+            if not self.threads:
+                self.start()
+        self.queue.put(upload)
+
+    def start (self):
+        for i in xrange(self.workers):
+            thread = threading.Thread(target = self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def run (self):
+        while True:
+            upload = self.queue.get()
+            try:
+                self.upload(upload)
+            except Exception, e:
+                log.error('Uploading %s %s failed: %s', upload.album,
+                          upload.name, e)
+            finally:
+                self.queue.task_done()
+
+    def upload (self, upload):
+        """ Upload one file, retrying failures """
+        with self.lock:
+            # Replaced by a rewrite, or journaled by drain()
+            skip = upload.state != 'pending'
+            if not skip:
+                upload.state = 'uploading'
+        if skip:
+            self.buf.clear_write(upload.album, upload.name, upload.buffer)
+            self.finish(upload)
+            return
+        try:
+            sha1 = upload.buffer.digest()
+        except Exception, e:
+            # Uploaded without looking for the same content on imgur
+            log.warning('Hashing %s %s failed: %s', upload.album, upload.name, e)
+            sha1 = None
+
+        def attempt ():
+            upload.attempts += 1
+            data = WriteBufferReader(upload.buffer)
+            with self.digest_locks(sha1):
+                return self.imgur.upload_image(upload.album, upload.name,
+                                               data, sha1)
+        def failed (error):
+            upload.error = str(error)
+        stop = self.journal != None and (Offline,) or ()
+        try:
+            record, error = upload_with_retries(attempt, self.retries,
+                                                self.backoff, stop, failed)
+        except Offline:
+            self.journal.add_upload(upload.album, upload.name,
+                                    WriteBufferReader(upload.buffer))
+            upload.state = 'journaled'
+            upload.error = None
+        else:
+            if record:
+                upload.state = 'done'
+                upload.error = None
+            else:
+                self.give_up(upload)
+
+        upload.time = time.time()
+        if upload.state == 'failed':
+            # No journal, the buffer is kept so the file can still be
+            # read and copied somewhere else
+            self.finish(upload)
+            return
+        # upload_image put the image into the index already, the
+        # AlbumBatcher expires the album once it was added there
+        self.buf.clear_write(upload.album, upload.name, upload.buffer)
+        self.finish(upload)
+
+    def give_up (self, upload):
+        """ Keep the data of an upload that ran out of retries in the
+            journal, it is tried again on the next mount """
+        if self.journal == None:
+            upload.state = 'failed'
+            log.error('Giving up uploading %s %s: %s', upload.album,
+                      upload.name, upload.error)
+            return
+        log.error('Giving up uploading %s %s for now, keeping it in the journal: %s',
+                  upload.album, upload.name, upload.error)
+        self.journal.add_upload(upload.album, upload.name,
+                                WriteBufferReader(upload.buffer))
+        upload.state = 'journaled'
+
+    def drain (self, timeout):
+        """ Wait up to timeout seconds for the queue to empty, then
+            move what is left to the journal, before we exit """
+        deadline = time.time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks and time.time() < deadline:
+                self.queue.all_tasks_done.wait(deadline - time.time())
+        with self.lock:
+            left = [u for u in self.uploads.values()
+                    if u.state in ('pending', 'uploading')]
+        for upload in left:
+            if self.journal == None:
+                log.error('Unmounting before %s %s was uploaded', upload.album,
+                          upload.name)
+                continue
+            log.warning('Journaling %s %s, it was not uploaded before unmount',
+                        upload.album, upload.name)
+            self.journal.add_upload(upload.album, upload.name,
+                                    WriteBufferReader(upload.buffer))
+            upload.state = 'journaled'
+
+    def finish (self, upload):
+        """ Move a finished upload to the history, failed ones stay
+            until the file is written again """
+        if upload.state == 'failed':
+            return
+        with self.lock:
+            if self.uploads.get((upload.album, upload.name)) is upload:
+                del self.uploads[(upload.album, upload.name)]
+            self.finished.append(upload)
+
+    def status (self, album = None):
+        """ Status of queued and failed uploads and the last finished
+            ones, as a list of dicts with album, name, state, attempts,
+            error and time """
+        with self.lock:
+            uploads = self.uploads.values() + list(self.finished)
+        return [u.as_dict() for u in uploads if album == None or u.album == album]
+
+class AlbumBatcher:
+    """ Coalesces images added to an album into a single api call
+
+        Hashes are sent once a batch is `size` long or its oldest hash
+        has waited `window` seconds. A failed batch is retried with
+        backoff, and split in half each time, so one bad hash doesn't
+        hold back the rest
+    """
+
+    def __init__ (self, imgur, window = 2, size = 50, retries = 3, backoff = 2):
+        self.imgur = imgur
+        self.window = window
+        self.size = size
+        self.retries = retries
+        self.backoff = backoff
+        self.cond = threading.Condition()
+        # album -> [[hash, attempts]]
+        self.pending = {}
+        # album -> time the batch is due
+        self.due = {}
+        # album -> largest batch to send, halved on failures
+        self.limits = {}
+        # (album, hash, error) of hashes we gave up on
+        self.failed = []
+        # Batches the worker took and is still sending
+        self.sending = 0
+        self.thread = None
+
+    def add (self, album, imagehash):
+        """ Queue imagehash to be added to album """
+        with self.cond:
+            self.queue(album, [[imagehash, 0]], time.time() + self.window)
+            if self.thread == None:
+                self.thread = threading.Thread(target = self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def queued (self, album):
+        """ Hashes waiting to be added to album """
+        with self.cond:
+            return [item[0] for item in self.pending.get(album, ())]
+
+    def queue (self, album, items, due):
+        """ Must be called with cond held """
+        self.pending.setdefault(album, []).extend(items)
+        self.due[album] = min(self.due.get(album, due), due)
+        if len(self.pending[album]) >= self.size:
+            self.due[album] = 0
+        self.cond.notify()
+
+    def next_batch (self, block = True):
+        """ Wait for a batch to be due and take it out of the queue
+            Returns None when nothing is queued and block is False
+        """
+        with self.cond:
+            while True:
+                now = time.time()
+                ready = [a for a in self.due if self.due[a] <= now or not block]
+                if ready:
+                    album = ready[0]
+                    items = self.pending[album]
+                    limit = self.limits.get(album, self.size)
+                    batch, rest = items[:limit], items[limit:]
+                    if rest:
+                        # A full batch left over goes right away, a
+                        # short one waits for more hashes
+                        self.pending[album] = rest
+                        if len(rest) < limit and block:
+                            self.due[album] = now + self.window
+                        else:
+                            self.due[album] = 0
+                    else:
+                        del self.pending[album]
+                        del self.due[album]
+                    if block:
+                        self.sending += 1
+                    return album, batch
+                if not block:
+                    return None
+                if self.due:
+                    self.cond.wait(max(min(self.due.values()) - now, 0.01))
+                else:
+                    self.cond.wait()
+
+    def run (self):
+        while True:
+            batch = self.next_batch()
+            try:
+                self.send(*batch)
+            finally:
+                with self.cond:
+                    self.sending -= 1
+                    self.cond.notify_all()
+
+    def send (self, album, batch):
+        """ Add a batch of hashes to album, requeue it on failure """
+        try:
+            self.imgur.add_images(album, [item[0] for item in batch])
+        except Exception, e:
+            retry = []
+            for item in batch:
+                item[1] += 1
+                if item[1] > self.retries:
+                    self.failed.append((album, item[0], str(e)))
+                    log.error('Giving up adding %s to %s: %s', item[0], album, e)
+                else:
+                    retry.append(item)
+            with self.cond:
+                self.limits[album] = max(1, len(batch) / 2)
+                if retry:
+                    delay = self.backoff ** max(item[1] for item in retry)
+                    self.queue(album, retry, time.time() + delay)
+            return
+        with self.cond:
+            self.limits.pop(album, None)
+        self.imgur.index.expire(album)
+
+    def flush (self):
+        """ Send everything that is queued right away, and wait for
+            what the worker is sending """
+        while True:
+            batch = self.next_batch(block = False)
+            if batch != None:
+                self.send(*batch)
+                continue
+            with self.cond:
+                if not self.sending and not self.pending:
+                    return
+                if self.sending:
+                    self.cond.wait()
+
+    def status (self):
+        """ Number of queued hashes and the hashes we gave up on """
+        with self.cond:
+            queued = sum(len(items) for items in self.pending.itervalues())
+        return dict(queued = queued, failed = list(self.failed))
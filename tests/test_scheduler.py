@@ -0,0 +1,62 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#=======================================================================
+#  imgurfs - Virtual file system for Imgur
+#  test_scheduler.py - Tests of the rate limit scheduler
+#  Copyright (c) 2012 Gaganpreet  <gaganpreet.arora@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+from imgurfs.scheduler import RequestScheduler, RateLimited, PRIORITY_NAMES, \
+                              INTERACTIVE, REFRESH
+
+class RequestSchedulerTest (unittest.TestCase):
+
+    def test_unpaced_with_budget_left (self):
+        scheduler = RequestScheduler()
+        scheduler.update(12000, 12500)
+        start = time.time()
+        for i in xrange(200):
+            scheduler.acquire()
+        self.assertTrue(time.time() - start < 1)
+
+    def test_exhausted_budget_refuses_until_reset (self):
+        scheduler = RequestScheduler()
+        scheduler.update(0, 100, time.time() + 0.5)
+        self.assertRaises(RateLimited, scheduler.acquire, INTERACTIVE)
+        time.sleep(0.6)
+        # No response came in, the reset alone brings the budget back
+        for priority in xrange(len(PRIORITY_NAMES)):
+            self.assertTrue(scheduler.allows(priority))
+            scheduler.acquire(priority)
+
+    def test_reserve_lifted_at_reset (self):
+        scheduler = RequestScheduler()
+        scheduler.update(10, 100, time.time() + 0.5)
+        self.assertFalse(scheduler.allows(REFRESH))
+        self.assertTrue(scheduler.allows(INTERACTIVE))
+        time.sleep(0.6)
+        self.assertTrue(scheduler.allows(REFRESH))
+
+if __name__ == '__main__':
+    unittest.main()